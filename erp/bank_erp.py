@@ -1,4 +1,8 @@
 from flask import Flask
+import src.routes as routes
+
+from src.bank import Bank
+from src.scheduler import Sealer
 from src.routes import erp
 
 app = Flask(__name__)
@@ -9,7 +13,34 @@ if __name__ == '__main__':
 
     parser = ArgumentParser()
     parser.add_argument('-p', '--port', default=5000, type=int, help='port to listen on')
+    parser.add_argument('-w', '--workers', default=None, type=int, help='proof of work processes (defaults to CPU count)')
+    parser.add_argument('-d', '--difficulty', default=16, type=int, help='leading zero bits required of a proof')
+    parser.add_argument('--data', default=None, help='directory for the on-disk block logs (in memory if omitted)')
+    parser.add_argument('--snapshot-every', default=100, type=int, help='blocks sealed between state snapshots')
+    parser.add_argument('--seal-pending', default=100, type=int, help='pending transactions that make a chain due for sealing')
+    parser.add_argument('--seal-age', default=5.0, type=float, help='seconds the oldest pending transaction may wait before its chain is sealed')
+    parser.add_argument('--manual-mining', action='store_true', help='only seal blocks when /mine is called')
+    parser.add_argument('--max-pending', default=10000, type=int, help='pending transactions allowed per chain')
+    parser.add_argument('--max-pending-bytes', default=16 * 1024 * 1024, type=int, help='encoded bytes of pending transactions allowed per chain')
+    parser.add_argument('--overflow', default='reject', choices=['reject', 'block'], help='answer 503 when a chain is full, or wait for the next seal')
     args = parser.parse_args()
     port = args.port
 
-    app.run(host='0.0.0.0', port=port)
\ No newline at end of file
+    routes.bank = Bank(
+        args.workers, args.difficulty, args.data, args.snapshot_every,
+        max_pending=args.max_pending, max_pending_bytes=args.max_pending_bytes, overflow=args.overflow
+    )
+    sealer = None
+    if not args.manual_mining:
+        sealer = Sealer(routes.bank, args.seal_pending, args.seal_age)
+        sealer.start()
+
+    # Bank guards its own state, so requests are served on threads. On the
+    # way out, sealing stops before the bank writes its last snapshot and
+    # syncs the block logs
+    try:
+        app.run(host='0.0.0.0', port=port, threaded=True)
+    finally:
+        if sealer is not None:
+            sealer.stop()
+        routes.bank.close()
\ No newline at end of file
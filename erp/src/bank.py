@@ -1,26 +1,50 @@
-from .hr import Employee
+from .hr import Employee, EmployeeView, Directory, load_employee
 from .repo import RepoPortfolio, Repo
 from .interbank import InterbankLoanPortfolio
-from .clients import Client, Account
-
-import json
+from .clients import Client, ClientView, fold, find_account, load_client, copy_account, withdrawal, check_transfer
+from .compounding import compound
+from .reserves import Reserves
+from .mining import Miner, DIFFICULTY, valid_proof
+from .storage import BlockLog
+from .journal import Journal
+from .mempool import Mempool
+from .merkle import merkle_root, valid_root, inclusion_proof
+from .snapshot import write_snapshot, load_snapshots
+from . import codec
+
+import os
 import requests
 import hashlib
+import threading
 
+from concurrent.futures import ThreadPoolExecutor
+from collections import Counter
+from contextlib import ExitStack, contextmanager
 from urllib.parse import urlparse
 from uuid import uuid4
 from time import time
 
 class Bank:
 
-    def __init__(self):
+    def __init__(self, workers=None, difficulty=DIFFICULTY, data_dir=None, snapshot_every=100, checkpoint_every=50,
+                 max_pending=10000, max_pending_bytes=16 * 1024 * 1024, overflow='reject'):
         self.nodes = set()
-        self.chains = {
-            'meta': [],
-            'finance': [],
-            'hr': [],
-            'clients': []
-        }
+        self.miner = Miner(workers, difficulty)
+        self.data_dir = data_dir
+        # Blocks sealed between state snapshots
+        self.snapshot_every = snapshot_every
+        self.sealed_since_snapshot = 0
+        # Client events recorded before a full client checkpoint is written
+        self.checkpoint_every = checkpoint_every
+        if data_dir is None:
+            self.chains = {
+                'meta': [],
+                'finance': [],
+                'hr': [],
+                'clients': []
+            }
+        else:
+            self.chains = {type: BlockLog(os.path.join(data_dir, type)) for type in ['meta', 'finance', 'hr', 'clients']}
 
         self.current_transactions = {
             'meta': [],
@@ -28,11 +52,63 @@ class Bank:
             'hr': [],
             'clients': []
         }
+        # Encoding of each pending transaction, reused for its mempool size,
+        # its merkle leaf and the body of the block that seals it
+        self.encoded_transactions = {type: [] for type in self.chains}
+        # Bounds on each chain's pending transactions
+        self.mempools = {type: Mempool(max_pending, max_pending_bytes, overflow) for type in self.chains}
+        # Undo log of the batch being applied, if any
+        self.journal = None
+        # Per chain, an undo log of its pending transactions, so a peer's
+        # blocks can be slotted in underneath them
+        self.pending_journals = {type: None for type in self.chains}
+
+        # Each chain lock guards that chain, its pending transactions and the
+        # state folded from them; the aggregates lock guards the running
+        # totals every chain feeds. Chain locks are taken before it.
+        self.locks = {type: threading.RLock() for type in self.chains}
+        self.aggregates_lock = threading.Lock()
+        # Notified whenever blocks are added, for callers awaiting a receipt
+        self.sealed = threading.Condition()
+        # When the oldest pending transaction of each chain arrived
+        self.pending_since = {type: None for type in self.chains}
+
+        # Number of leading blocks per chain whose links are already verified
+        self.verified = {
+            'meta': 0,
+            'finance': 0,
+            'hr': 0,
+            'clients': 0
+        }
 
+        # Pooled keep-alive connections for syncing with peers
+        self.session = requests.Session()
+        self.peer_timeout = 10
+        self.sync_page = 500
+
+        self.reset_state()
+        if any(len(chain) for chain in self.chains.values()):
+            self.replay(self.load_snapshot())
+        else:
+            self.genesis()
+
+    def reset_state(self):
         self.employees = []
         self.clients = []
 
-        self.genesis()
+        self.meta = None
+        # Latest known state per bank_num, including pending transactions,
+        # folded from checkpoints and the events after them
+        self.client_states = {}
+        self.client_events = {}
+        self.directory = Directory()
+        # Latest finance record of each type, keyed by its 'record' tag
+        self.finance_heads = {
+            'interbank': None,
+            'repo': None
+        }
+        # Running totals behind /finance/reserves
+        self.aggregates = Reserves()
 
     # ----------------------------------
     #            Blockchain
@@ -50,6 +126,163 @@ class Bank:
                 self.add_transaction(type, interbank.mapped)
             self.add_block(type, 100, 1)
 
+    def replay(self, heights=None):
+        # Rebuild the materialized state from blocks in storage, starting after
+        # the heights already covered by a snapshot
+        for type in ['meta', 'finance', 'hr', 'clients']:
+            start = heights[type] if heights else 0
+            for index in range(start, len(self.chains[type])):
+                for data in self.chains[type][index]['transactions']:
+                    self.index_transaction(type, data)
+
+    @property
+    def state(self):
+        return {
+            'meta': self.meta,
+            'finance': self.finance_heads,
+            'clients': {bank_num: state.mapped for bank_num, state in self.client_states.items()},
+            'employees': {employee_num: employee.mapped for employee_num, employee in self.directory.employees.items()},
+            'aggregates': self.aggregates.mapped
+        }
+
+    def restore(self, state):
+        self.meta = state['meta']
+        self.finance_heads = dict(state['finance'])
+        self.client_states = {bank_num: load_client(record) for bank_num, record in state['clients'].items()}
+        self.client_events = {bank_num: 0 for bank_num in self.client_states}
+        self.clients = list(self.client_states)
+
+        self.directory = Directory()
+        for record in state['employees'].values():
+            self.directory.update(load_employee(record))
+        self.employees = list(self.directory.employees)
+
+        self.aggregates = Reserves(**state['aggregates'])
+
+    def snapshot(self):
+        """
+        Write the materialized state, tagged with the height and tip hash of
+        every chain it matches. Pending transactions are folded into the
+        state, so they are taken out while it is written.
+
+        :return: <str> path of the snapshot, or None without a data dir
+        """
+        with self.locked(*self.chains):
+            if self.data_dir is None:
+                return None
+
+            # The blocks a snapshot points at have to be durable before it is
+            for chain in self.chains.values():
+                chain.sync()
+
+            with self.without_pending():
+                snapshot = {
+                    'heights': {type: len(chain) for type, chain in self.chains.items()},
+                    'hashes': {type: chain[-1]['hash'] for type, chain in self.chains.items()},
+                    'state': self.state
+                }
+                path = write_snapshot(os.path.join(self.data_dir, 'snapshots'), snapshot)
+            self.sealed_since_snapshot = 0
+            return path
+
+    @contextmanager
+    def without_pending(self):
+        # Roll every chain's pending transactions out of the state, then fold
+        # them back in; callers hold all the chain locks. The journals stay
+        # valid, since the same transactions touch the same entries again
+        pending = {}
+        with self.aggregates_lock:
+            for type, journal in self.pending_journals.items():
+                if journal is not None and self.current_transactions[type]:
+                    pool = self.mempools[type]
+                    pending[type] = (list(self.current_transactions[type]), list(self.encoded_transactions[type]), pool.count, pool.bytes)
+                    journal.rollback()
+        try:
+            yield
+        finally:
+            with self.aggregates_lock:
+                for type, (transactions, encoded, count, size) in pending.items():
+                    for data in transactions:
+                        self.index_transaction(type, data)
+                    self.current_transactions[type].extend(transactions)
+                    self.encoded_transactions[type].extend(encoded)
+                    self.mempools[type].restore(count, size)
+
+    def load_snapshot(self):
+        # Restore the newest snapshot that still matches the stored chains and
+        # return the heights it covers, or None to replay from genesis
+        if self.data_dir is None:
+            return None
+
+        for snapshot in load_snapshots(os.path.join(self.data_dir, 'snapshots')):
+            heights, hashes = snapshot['heights'], snapshot['hashes']
+            if all(
+                0 < heights[type] <= len(self.chains[type]) and self.chains[type][heights[type] - 1]['hash'] == hashes[type]
+                for type in ['meta', 'finance', 'hr', 'clients']
+            ):
+                self.restore(snapshot['state'])
+                return heights
+        return None
+
+    @contextmanager
+    def locked(self, *types):
+        # Chain locks are always taken in the same order, so holders of
+        # several never deadlock
+        with ExitStack() as stack:
+            for type in self.chains:
+                if type in types:
+                    stack.enter_context(self.locks[type])
+            yield
+
+    @contextmanager
+    def admit(self, counts):
+        """
+        Reserve room in the mempools for writes about to be made.
+
+        Admission happens before any chain lock is taken, so a writer
+        waiting for room never holds up the seal that would make it.
+
+        :param counts: <dict> number of transactions per chain type
+        """
+        with ExitStack() as stack:
+            for type in self.chains:
+                n = counts.get(type, 0)
+                if n:
+                    self.mempools[type].reserve(n)
+                    stack.callback(self.mempools[type].release, n)
+            yield
+
+    def mempool_stats(self):
+        stats = {}
+        for type, pool in self.mempools.items():
+            since = self.pending_since[type]
+            stats[type] = dict(pool.mapped, oldest_age=time() - since if since is not None and pool.count else 0)
+        return stats
+
+    def pending(self):
+        # Copies, so readers never iterate a list that is being appended to
+        pending = {}
+        for type in self.chains:
+            with self.locks[type]:
+                pending[type] = list(self.current_transactions[type])
+        return pending
+
+    def chain_snapshot(self, type):
+        # Sealed blocks never change, so a copy of the list is a stable view;
+        # a BlockLog only ever appends, except on a fork
+        chain = self.chains[type]
+        if isinstance(chain, BlockLog):
+            return chain
+        with self.locks[type]:
+            return chain[:]
+
+    def close(self):
+        self.snapshot()
+        for chain in self.chains.values():
+            if isinstance(chain, BlockLog):
+                chain.close()
+        self.miner.close()
+
     def register_node(self, authorizer, address):
         if self.nodes:
             print(self.nodes)
@@ -66,64 +299,578 @@ class Bank:
         else:
             raise ValueError('Invalid URL')
         
-    def validate_chains(self, chains):
+    def validate_chains(self, chains, full=False):
         for type in ['meta', 'finance', 'hr', 'clients']:
-            last_block = chains[type][0]
-            current_index = 1
-
-            while current_index < len(chains[type]):
-                block = chains[type][current_index]
-                print(f'{last_block}')
-                print(f'{block}')
-                print('\n ------------------------------ \n')
-                last_block_hash = self.hash(last_block)
+            if not self.validate_chain(type, chains[type], full):
+                return False
+        return True
+
+    def validate_chain(self, type, chain, full=False):
+        """
+        Check the hash links and proofs of a chain, skipping the prefix already verified.
+
+        For our own chain that prefix is everything below the watermark. For a
+        peer chain it is the part whose block hashes match our verified blocks,
+        so only the diverging suffix is hashed. The peer's copies of prefix
+        blocks are not read, so adopting the chain means keeping our own
+        prefix and taking only the suffix. full re-verifies from genesis
+        across the miner's process pool.
+
+        :param type: <str> chain type
+        :param chain: <list> blocks to check
+        :param full: <bool> ignore the watermark and recompute every hash
+        :return: <bool>
+        """
+        own = chain is self.chains[type]
+        if full:
+            if own:
+                # Proofs are checked outside the lock, over the blocks sealed so far
+                with self.locks[type]:
+                    length = len(chain)
+                chain = [chain[index] for index in range(length)]
+            if self.miner.verify(chain, self.compute_hash) is not None:
+                return False
+            if own:
+                with self.locks[type]:
+                    self.verified[type] = max(self.verified[type], length)
+            return True
+
+        if own:
+            with self.locks[type]:
+                return self.validate_suffix(type, chain, self.verified[type])
+        return self.validate_suffix(type, chain, self.shared_prefix(type, chain))
+
+    def validate_suffix(self, type, chain, prefix):
+        own = chain is self.chains[type]
+
+        # Restart at the last block of the prefix so its successor can be linked
+        # to it; a peer's copy of that block is hashed to prove it matches ours
+        start = max(prefix - 1, 0)
+        last_block = None
+        last_block_hash = None
+
+        for index in range(start, len(chain)):
+            block = chain[index]
+            block_hash = self.hash(block) if own else self.compute_hash(block)
+            if block.get('hash', block_hash) != block_hash:
+                return False
+            if not own and not valid_root(block):
+                return False
+            if index > start:
                 if block['previous_hash'] != last_block_hash:
                     return False
-                
-                last_block = block
-                current_index += 1
-            
+                if not self.valid_proof(last_block['proof'], block['proof'], last_block_hash, self.miner.difficulty):
+                    return False
+            last_block = block
+            last_block_hash = block_hash
+
+        if own:
+            self.verified[type] = len(chain)
         return True
 
+    def audit(self):
+        # Full parallel verification of every chain; maps each chain type to the
+        # index of its first invalid block, or None
+        return {type: self.miner.verify(self.chain_snapshot(type), self.compute_hash) for type in self.chains}
+
+    def shared_prefix(self, type, chain):
+        # Number of leading blocks whose hashes match our verified blocks
+        ours = self.chains[type]
+        low, high = 0, min(self.verified[type], len(chain))
+        while low < high:
+            mid = (low + high + 1) // 2
+            if chain[mid - 1].get('hash') == ours[mid - 1]['hash']:
+                low = mid
+            else:
+                high = mid - 1
+        return low
+
+    def locator(self, type):
+        # Positions and hashes of our blocks, dense near the tip and doubling
+        # their spacing towards genesis, so a common ancestor is found in one
+        # round trip with O(log n) hashes
+        chain = self.chain_snapshot(type)
+        locator = []
+        position, step = len(chain) - 1, 1
+        while position > 0:
+            locator.append([position, chain[position]['hash']])
+            if len(locator) >= 10:
+                step *= 2
+            position -= step
+        locator.append([0, chain[0]['hash']])
+        return locator
+
+    def find_ancestor(self, type, locator):
+        with self.locks[type]:
+            chain = self.chains[type]
+            for position, block_hash in locator:
+                if position < len(chain) and chain[position]['hash'] == block_hash:
+                    return position
+            return -1
+
     def resolve_conflicts(self):
-        pass
+        """
+        Sync every chain with our peers, adopting any longer valid chain.
+
+        For each chain we send a locator of our block hashes, learn the
+        newest block we share with the peer, and download only the blocks
+        after it.
+
+        :return: <dict> chain types that were replaced
+        """
+        replaced = {type: False for type in ['meta', 'finance', 'hr', 'clients']}
+        for node in list(self.nodes):
+            for type in replaced:
+                try:
+                    suffix = self.fetch_suffix(node, type)
+                except (requests.RequestException, ValueError, KeyError):  # Unreachable peer or malformed response
+                    continue
+                if suffix is not None and self.sync_chain(type, *suffix):
+                    replaced[type] = True
+        return replaced
+
+    def fetch_suffix(self, node, type):
+        # The peer's blocks after the newest one we share, as (ancestor, blocks),
+        # or None if the peer has nothing longer
+        response = self.session.post(f'http://{node}/chains/{type}/locate', json={'locator': self.locator(type)}, timeout=self.peer_timeout)
+        if response.status_code != 200:
+            return None
+        values = response.json()
+        if values['length'] <= len(self.chains[type]):
+            return None
+
+        ancestor = values['ancestor']
+        if not isinstance(ancestor, int) or not -1 <= ancestor < len(self.chains[type]):
+            raise ValueError("Peer named an ancestor outside our chain")
+        blocks = []
+        cursor = ancestor + 1
+        while cursor is not None:
+            response = self.session.get(
+                f'http://{node}/chains/{type}',
+                params={'cursor': cursor, 'limit': self.sync_page},
+                headers={'Accept': codec.MIMETYPE},
+                timeout=self.peer_timeout
+            )
+            if response.status_code != 200:
+                return None
+            # A binary page is a header document followed by one document per block
+            documents = codec.decode_stream(response.content)
+            page = next(documents)
+            blocks.extend(documents)
+            cursor = page['next']
+        return ancestor, blocks
+
+    def sync_chain(self, type, ancestor, blocks):
+        # Adopt a verified suffix; a fork rebuilds every chain's state, so
+        # this takes all the locks
+        with self.locked(*self.chains):
+            if ancestor >= len(self.chains[type]):
+                return False  # Our chain was replaced since the fetch
+            encoded = self.verify_suffix(type, ancestor, blocks)
+            if encoded is None or ancestor + 1 + len(blocks) <= len(self.chains[type]):
+                return False
+
+            self.adopt(type, ancestor, blocks, encoded)
+            return True
+
+    def verify_suffix(self, type, ancestor, blocks):
+        # Check peer blocks that follow our block at position ancestor and
+        # return their canonical encodings, or None if any link is invalid
+        encoded = []
+        if ancestor >= 0:
+            last_block = self.chains[type][ancestor]
+            last_block_hash = last_block['hash']
+        else:
+            last_block = last_block_hash = None
+
+        for block in blocks:
+            contents = self.encode(block)
+            header = self.header(block) if 'merkle_root' in block else contents
+            block_hash = hashlib.sha256(header).hexdigest()
+            if block.get('hash', block_hash) != block_hash or not valid_root(block):
+                return None
+            if last_block is not None:
+                if block['previous_hash'] != last_block_hash:
+                    return None
+                if not self.valid_proof(last_block['proof'], block['proof'], last_block_hash, self.miner.difficulty):
+                    return None
+            block['hash'] = block_hash
+            encoded.append(contents)
+            last_block, last_block_hash = block, block_hash
+        return encoded
+
+    def adopt(self, type, ancestor, blocks, encoded):
+        chain = self.chains[type]
+        extends = ancestor + 1 == len(chain)
+        # Pending interbank records hold the whole position, so they are
+        # rebased onto the new chain by their change from this sealed head
+        interbank = None
+        if any(self.finance_record(data) == 'interbank' for data in self.current_transactions['finance']):
+            interbank = self.sealed_interbank()
+
+        if isinstance(chain, BlockLog):
+            chain.truncate(ancestor + 1)
+            for block, contents in zip(blocks, encoded):
+                chain.append(block, contents)
+        else:
+            del chain[ancestor + 1:]
+            chain.extend(blocks)
+        self.verified[type] = len(chain)
+        with self.sealed:
+            self.sealed.notify_all()
+
+        if not extends:
+            self.rebuild(interbank)
+            return
+
+        # Only new blocks arrived: take this chain's pending transactions out
+        # of the state, fold the new blocks, then put pending back on top
+        pending = list(self.current_transactions[type])
+        since = self.pending_since[type]
+        with self.aggregates_lock:
+            if self.pending_journals[type] is not None:
+                self.pending_journals[type].rollback()
+                self.pending_journals[type] = None
+            for block in blocks:
+                for data in block['transactions']:
+                    self.index_transaction(type, data)
+        self.pending_since[type] = None
+        self.report_dropped(self.readmit(type, pending, since, interbank))
+
+    def sealed_interbank(self):
+        # Latest interbank record in a sealed finance block
+        chain = self.chains['finance']
+        for index in range(len(chain) - 1, -1, -1):
+            for data in reversed(chain[index]['transactions']):
+                if self.finance_record(data) == 'interbank':
+                    return data
+        return None
+
+    def rebuild(self, interbank=None):
+        """
+        Rebuild the materialized state from the newest snapshot still on the
+        chains, then re-apply pending transactions.
+
+        A pending transaction that no longer applies (say an event for a
+        client that only existed in our orphaned blocks) is dropped rather
+        than left to be sealed into a block nobody can replay.
+
+        :param interbank: <dict> sealed interbank record our pending ones were based on
+        :return: <int> number of pending transactions dropped
+        """
+        pending = self.current_transactions
+        since = dict(self.pending_since)
+        self.current_transactions = {type: [] for type in self.chains}
+        self.encoded_transactions = {type: [] for type in self.chains}
+        for type in self.chains:
+            self.pending_since[type] = None
+            self.pending_journals[type] = None
+            self.mempools[type].clear()
+
+        self.reset_state()
+        self.replay(self.load_snapshot())
+
+        dropped = sum(
+            self.readmit(type, pending[type], since[type], interbank)
+            for type in ['meta', 'finance', 'hr', 'clients']
+        )
+        self.report_dropped(dropped)
+        return dropped
+
+    def readmit(self, type, pending, since=None, interbank=None):
+        """
+        Add a chain's pending transactions again on top of changed sealed state.
+
+        :param type: <str> chain type
+        :param pending: <list> the pending transactions, oldest first
+        :param since: <float> when the oldest of them arrived
+        :param interbank: <dict> sealed interbank record they were based on
+        :return: <int> number dropped because they no longer apply
+        """
+        dropped = 0
+        for data in pending:
+            if type == 'finance' and self.finance_record(data) == 'interbank':
+                data, interbank = self.rebase_interbank(data, interbank), data
+            elif type == 'clients':
+                data = self.rebase_client(data)
+            try:
+                if data is None:
+                    raise ValueError("Transaction no longer applies")
+                self.add_transaction(type, data)
+            except (ValueError, KeyError):
+                dropped += 1
+        if self.current_transactions[type] and since is not None:
+            self.pending_since[type] = since
+        return dropped
+
+    @staticmethod
+    def report_dropped(dropped):
+        if dropped:
+            print(f"Dropped {dropped} pending transactions that no longer apply")
+
+    def rebase_interbank(self, data, base):
+        # Carry the record's change from its old base over to the current head
+        head = self.finance_heads['interbank']
+        if base is None or head is None:
+            return data
+        rebased = dict(data)
+        for key in ('assets', 'liabilities', 'cash'):
+            rebased[key] = head[key] + data[key] - base[key]
+        return rebased
+
+    def rebase_client(self, data):
+        record = data.get('record')
+        if record == 'interest':
+            # Only accounts that still exist are compounded
+            accounts = []
+            for bank_num, account_nums in data['accounts']:
+                state = self.client_states.get(bank_num)
+                if state is None:
+                    continue
+                existing = {account.account_num for account in state.accounts}
+                account_nums = [account_num for account_num in account_nums if account_num in existing]
+                if account_nums:
+                    accounts.append([bank_num, account_nums])
+            return {'record': 'interest', 'accounts': accounts} if accounts else None
+        if record != 'event' and data['bank_num'] in self.client_states:
+            # A checkpoint of an existing client is retaken from the rebuilt
+            # state, so it can't overwrite what the peer's blocks did
+            return self.get_client(data['bank_num']).mapped
+        return data
 
     def add_block(self, type, proof, previous_hash):
+        # Callers hold the chain lock, except while the node starts up
+        transactions = self.encoded_transactions[type]
         block = {
             'index': len(self.chains[type]) + 1,
             'timestamp': time(),
             'transactions': self.current_transactions[type],
             'proof': proof,
             'previous_hash': previous_hash,
+            'merkle_root': merkle_root(transactions)
         }
+        # Sealed blocks never change, so they are serialized and hashed exactly
+        # once, from the transactions' encodings made when they were accepted
+        encoded = self.encode({**block, 'transactions': transactions})
+        block['hash'] = hashlib.sha256(self.header(block)).hexdigest()
 
         self.current_transactions[type] = []
-        self.chains[type].append(block)
-        
+        self.encoded_transactions[type] = []
+        self.pending_journals[type] = None
+        self.pending_since[type] = None
+        self.mempools[type].clear()
+        if isinstance(self.chains[type], BlockLog):
+            self.chains[type].append(block, encoded)
+        else:
+            self.chains[type].append(block)
+
+        with self.sealed:
+            self.sealed.notify_all()
         return block
 
+    def seal(self, type):
+        # The proof of work runs without the lock, so writers keep appending
+        # meanwhile; the proof only depends on the tip, so the block takes
+        # everything pending once the tip is confirmed unchanged
+        while True:
+            with self.locks[type]:
+                if not self.current_transactions[type]:
+                    return None
+                last_block = self.chains[type][-1]
+
+            proof = self.proof_of_work(last_block)
+
+            with self.locks[type]:
+                if self.chains[type][-1]['hash'] != last_block['hash']:
+                    continue  # Another seal or a peer's chain moved the tip
+                if not self.current_transactions[type]:
+                    return None
+                return self.add_block(type, proof, self.hash(last_block))
+
+    def mine(self, types=None):
+        # Each chain with pending transactions is sealed on its own thread, and
+        # the proof of work searches share the miner's process pool
+        pending = [type for type in (types or ['meta', 'finance', 'hr', 'clients']) if self.current_transactions[type]]
+        if not pending:
+            return {}
+
+        with ThreadPoolExecutor(max_workers=len(pending)) as executor:
+            futures = {type: executor.submit(self.seal, type) for type in pending}
+        blocks = {type: future.result() for type, future in futures.items()}
+        blocks = {type: block for type, block in blocks.items() if block is not None}
+
+        with self.locked(*self.chains):
+            self.sealed_since_snapshot += len(blocks)
+            if self.sealed_since_snapshot >= self.snapshot_every:
+                self.snapshot()
+        return blocks
+
+    def transaction_proof(self, type, index, position):
+        """
+        Inclusion proof for one transaction of a sealed block.
+
+        :param type: <str> chain type
+        :param index: <int> block index
+        :param position: <int> position of the transaction in the block
+        :return: <dict> the transaction, the block header and the sibling path to its merkle root
+        """
+        chain = self.chains[type]
+        if not 1 <= index <= len(chain):
+            raise ValueError("Block not found")
+        block = chain[index - 1]
+        if 'merkle_root' not in block:
+            raise ValueError("Block was sealed without a merkle root")
+
+        proof = inclusion_proof(block['transactions'], position)
+        return {
+            'transaction': block['transactions'][position],
+            'position': position,
+            'proof': proof,
+            'header': {key: value for key, value in block.items() if key != 'transactions'}
+        }
+
+    def await_block(self, type, index, timeout=None):
+        """
+        Wait until the block a receipt points at has been sealed.
+
+        :param type: <str> chain type
+        :param index: <int> block index from the receipt
+        :param timeout: <float> seconds to wait, or None to wait indefinitely
+        :return: <dict> the sealed block, or None on timeout
+        """
+        chain = self.chains[type]
+        with self.sealed:
+            if not self.sealed.wait_for(lambda: len(chain) >= index, timeout):
+                return None
+        return chain[index - 1]
+
     def add_transaction(self, type, data):
         if type not in ['meta', 'finance', 'hr', 'clients']:
             raise ValueError("Transaction type not recognized.")
 
-        self.current_transactions[type].append(data)
+        with self.locks[type]:
+            if self.journal is not None:
+                self.journal.record(type, data)
+            if not self.current_transactions[type]:
+                self.pending_journals[type] = Journal(self, [type])
+            self.pending_journals[type].record(type, data)
+            with self.aggregates_lock:
+                self.index_transaction(type, data)
+            if not self.current_transactions[type]:
+                self.pending_since[type] = time()
+            encoded = codec.Encoded(codec.encode(data))
+            self.current_transactions[type].append(data)
+            self.encoded_transactions[type].append(encoded)
+            self.mempools[type].add(len(encoded))
+
+            if len(self.chains[type]) == 0:
+                return 1
+            return self.chains[type][-1]['index'] + 1
+
+    def index_transaction(self, type, data):
+        # Keep the materialized state in step with every transaction that is
+        # accepted, so lookups never have to walk the chain
+        if type == 'meta':
+            self.meta = data
+        elif type == 'clients':
+            if data.get('record') == 'interest':
+                # One batch record compounds every listed account at its own
+                # rate; the accounts are copied first so published states
+                # are never changed
+                states = {}
+                accounts = []
+                for bank_num, account_nums in data['accounts']:
+                    state = self.client_states[bank_num]
+                    state = states[bank_num] = Client(state.bank_num, state.n_accounts, [copy_account(account) for account in state.accounts])
+                    accounts.extend(find_account(state.accounts, account_num) for account_num in account_nums)
+                for account_type, change in compound(accounts).items():
+                    self.aggregates.update_deposit(account_type, change)
+                self.client_states.update(states)
+                return
+
+            bank_num = data['bank_num']
+            if data.get('record') == 'event':
+                try:
+                    state, changes = fold(self.client_states[bank_num], data)
+                except KeyError:
+                    raise ValueError("Client not found")
+                for account_type, change in changes:
+                    self.aggregates.update_deposit(account_type, change)
+                self.client_states[bank_num] = state
+                self.client_events[bank_num] += 1
+                return
+
+            # Anything else is a full checkpoint
+            previous = self.client_states.get(bank_num)
+            if previous is None:
+                self.clients.append(bank_num)
+            state = load_client(data)
+            self.aggregates.update_client(previous, state)
+            self.client_states[bank_num] = state
+            self.client_events[bank_num] = 0
+        elif type == 'hr':
+            previous = self.directory.employees.get(data['employee_num'])
+            if previous is None:
+                self.employees.append(data['employee_num'])
+            employee = load_employee(data)
+            self.aggregates.update_employee(previous, employee)
+            self.directory.update(employee)
+        elif type == 'finance':
+            record = self.finance_record(data)
+            if record == 'interbank':
+                self.finance_heads['interbank'] = data
+                self.aggregates.update_interbank(self.get_interbank())
+                return
+
+            if record == 'repo_trade':
+                portfolio = self.get_repo()
+                portfolio.add(Repo(data['ytm'], data['flag'], data['par']))
+            elif 'portfolio' in data:  # Whole-portfolio records written before trade events
+                portfolio = RepoPortfolio(portfolio=[Repo(bond['ytm'], bond['flag'], bond['par']) for bond in data['portfolio']])
+            else:
+                portfolio = RepoPortfolio(data['number'], data['reserves'], data['present_value'])
+            self.finance_heads['repo'] = portfolio.mapped
+            self.aggregates.update_repo(portfolio)
+
+    @staticmethod
+    def finance_record(data):
+        if 'record' in data:
+            return data['record']
+        # Records written before finance entries were tagged
+        return 'repo' if 'portfolio' in data else 'interbank'
+
+    @staticmethod
+    def encode(block):
+        contents = {key: value for key, value in block.items() if key != 'hash'}
+        return codec.encode(contents)
+
+    @staticmethod
+    def header(block):
+        # With a merkle root the hash covers the header alone, and the root
+        # commits to the transactions; older blocks hash everything
+        if 'merkle_root' not in block:
+            return Bank.encode(block)
+        contents = {key: value for key, value in block.items() if key not in ('hash', 'transactions')}
+        return codec.encode(contents)
 
-        if len(self.chains[type]) == 0:
-            return 1
-        return self.chains[type][-1]['index'] + 1
+    @staticmethod
+    def compute_hash(block):
+        return hashlib.sha256(Bank.header(block)).hexdigest()
 
     @staticmethod
     def hash(block):
-        print(block)
-        block_str = json.dumps(block, sort_keys=True).encode()
-        return hashlib.sha256(block_str).hexdigest()
+        if 'hash' in block:
+            return block['hash']
+        return Bank.compute_hash(block)
 
     def proof_of_work(self, last_block):
         """
         Simple Proof of Work Algorithm:
 
-         - Find a number p' such that hash(pp') contains leading 4 zeroes
-         - Where p is the previous proof, and p' is the new proof
+         - Find a number p' such that hash(p h p') starts with the miner's
+           difficulty in zero bits (16 bits is the old 4 hex zeroes)
+         - Where p is the previous proof, h the previous block hash, and p' is the new proof
+         - The search is split across the miner's worker processes
          
         :param last_block: <dict> last Block
         :return: <int>
@@ -132,21 +879,14 @@ class Bank:
         last_proof = last_block['proof']
         last_hash = self.hash(last_block)
 
-        proof = 0
-        while self.valid_proof(last_proof, proof, last_hash) is False:
-            proof += 1
-
-        return proof
+        return self.miner.proof_of_work(last_proof, last_hash)
 
     @staticmethod
-    def valid_proof(last_proof, proof, last_hash):
+    def valid_proof(last_proof, proof, last_hash, difficulty=DIFFICULTY):
         """
         Check if proof meets the target
         """
-        guess = f'{last_proof}{proof}{last_hash}'.encode()
-        guess_hash = hashlib.sha256(guess).hexdigest()
-
-        return guess_hash[:4] == "0000"
+        return valid_proof(last_proof, proof, last_hash, difficulty)
 
     # ----------------------------------
     #               Meta
@@ -161,8 +901,7 @@ class Bank:
         return new_index
 
     def get_meta(self):
-        meta = self.chains['meta'][-1]['transactions'][-1]
-        return meta
+        return self.meta
 
     # ----------------------------------
     #              Finance
@@ -170,99 +909,63 @@ class Bank:
 
     @property
     def reserves(self) -> float:
-        # Calculate total reserves first
-        interbank = self.get_interbank().cash
-        repo = self.get_repo().reserves
-
-        client_reserves = 0
-        for bank_num in self.clients:
-            client = self.get_client(bank_num)
-            for account in client.accounts:
-                client_reserves += account.amount
-
-        # Calculate liabilities from employee salaries
-        payroll = 0
-        for employee_num in self.employees:
-            employee = self.get_employee(employee_num)
-            payroll += employee.salary
-        
-        return interbank + repo + client_reserves - payroll
+        with self.aggregates_lock:
+            return self.aggregates.total
 
     def validate_reserves(self) -> bool:
-        liabilities = self.get_interbank().liabilities
-        repo = self.get_repo().reserves
         reserve_ratio = self.get_meta()['reserve_ratio']
-
-        client_reserves = 0
-        for bank_num in self.clients:
-            client = self.get_client(bank_num)
-            for account in client.accounts:
-                client_reserves += account.amount
-
-        if (client_reserves + repo - liabilities) / (client_reserves + repo) >= reserve_ratio:
-            return True
-        return False
+        with self.aggregates_lock:
+            return self.aggregates.ratio_met(reserve_ratio)
 
     def get_interbank(self) -> InterbankLoanPortfolio:
-        i = len(self.chains['finance']) - 1
-        while i >= 0:
-            block = self.chains['finance'][i]
-            j = len(block['transactions']) - 1
-            while j >= 0:
-                try:
-                    inter = block['transactions'][j]
-                    return InterbankLoanPortfolio(inter['interest'], inter['assets'], inter['liabilities'], inter['cash'])
-                except KeyError:  # Caught if the current transaction isn't for an InterbankLoanPortfolio
-                    continue
+        inter = self.finance_heads['interbank']
+        return InterbankLoanPortfolio(inter['interest'], inter['assets'], inter['liabilities'], inter['cash'])
 
     def borrow(self, amount):
-        interbank = self.get_interbank()
-        new_cash = interbank.borrow(amount)
-        index = self.add_transaction('finance', interbank.mapped)
+        with self.locks['finance']:
+            interbank = self.get_interbank()
+            new_cash = interbank.borrow(amount)
+            index = self.add_transaction('finance', interbank.mapped)
 
-        return new_cash, index
+            return new_cash, index
 
     def lend(self, amount):
-        interbank = self.get_interbank()
-        new_cash = interbank.lend(amount)
-        index = self.add_transaction('finance', interbank.mapped)
+        with self.locks['finance']:
+            interbank = self.get_interbank()
+            new_cash = interbank.lend(amount)
+            index = self.add_transaction('finance', interbank.mapped)
 
-        return new_cash, index
+            return new_cash, index
 
     def interbank_compound_interest(self):
-        interbank = self.get_interbank()
-        net_value = interbank.compound_interest()
-        index = self.add_transaction('finance', interbank.mapped)
+        with self.locks['finance']:
+            interbank = self.get_interbank()
+            net_value = interbank.compound_interest()
+            index = self.add_transaction('finance', interbank.mapped)
 
-        return net_value, index
+            return net_value, index
 
     def get_repo(self) -> RepoPortfolio:
-        i = len(self.chains['finance']) - 1
-        while i >= 0:
-            block = self.chains['finance'][i]
-            j = len(block['transactions']) - 1
-            while j >= 0:
-                try:
-                    repo = block['transactions'][j]
-                    return RepoPortfolio(repo['portfolio'])
-                except KeyError:  # Caught if the current transaction isn't for a RepoPortfolio
-                    continue
+        repo = self.finance_heads['repo']
+        return RepoPortfolio(repo['number'], repo['reserves'], repo['present_value'])
 
     def buy_repo(self, ytm, par=1000):
-        portfolio = self.get_repo()
-        repo = portfolio.buy_repo(ytm, par)
+        with self.locks['finance']:
+            portfolio = self.get_repo()
+            repo = portfolio.buy_repo(ytm, par)
 
-        index = self.add_transaction('finance', portfolio.mapped)
+            index = self.add_transaction('finance', {'record': 'repo_trade', **repo.mapped})
 
-        return repo.mapped, index
+            return repo.mapped, index
 
     def sell_repo(self, ytm, par=1000):
-        portfolio = self.get_repo()
-        repo = portfolio.sell_repo(ytm, par)
+        with self.locks['finance']:
+            portfolio = self.get_repo()
+            repo = portfolio.sell_repo(ytm, par)
 
-        index = self.add_transaction('finance', portfolio.mapped)
+            index = self.add_transaction('finance', {'record': 'repo_trade', **repo.mapped})
 
-        return repo.mapped, index
+            return repo.mapped, index
 
     # ----------------------------------
     #          Human Resources
@@ -270,23 +973,21 @@ class Bank:
 
     def add_employee(self, salary, department, supervisor_id):
         employee = Employee(uuid4().hex, salary, department, supervisor_id)
-        self.employees.append(employee.employee_num)
         index = self.add_transaction('hr', employee.mapped)
         
-        return index
+        return employee.employee_num, index
+
+    def get_employee(self, employee_num) -> EmployeeView:
+        # Records are replaced on update, never changed, so the view needs no lock
+        return EmployeeView(self.directory.get(employee_num))
+
+    def department_roster(self, department):
+        with self.locks['hr']:
+            return self.directory.roster(department)
 
-    def get_employee(self, employee_num) -> Employee:
-        i = len(self.chains['hr']) - 1
-        while i >= 0:
-            block = self.chains['hr'][i]
-            j = len(block['transactions']) - 1
-            while j >= 0:
-                current_emp = block['transactions'][j]
-                if current_emp['employee_num'] == employee_num:
-                    return Employee(current_emp['employee_num'], current_emp['salary'], current_emp['department'], current_emp['supervisor_id'])
-                j -= 1
-            i -= 1
-        raise ValueError("Invalid employee number.")
+    def reporting_tree(self, employee_num):
+        with self.locks['hr']:
+            return self.directory.reporting_tree(employee_num)
 
     # ----------------------------------
     #              Clients
@@ -294,77 +995,214 @@ class Bank:
 
     def add_client(self):
         client = Client(uuid4().hex)
-        self.clients.append(client.bank_num)
 
         index = self.add_transaction('clients', client.mapped)
 
-        return index
+        return client.bank_num, index
 
     def get_client(self, bank_num):
-        i = len(self.chains['clients']) - 1
-        while i >= 0:
-            block = self.chains['clients'][i]
-            j = len(block['transactions']) - 1
-            while j >= 0:
-                current_client = block['transactions'][j]
-                if current_client['bank_num'] == bank_num:
-                    accounts = []
-                    for account in current_client['accounts']:
-                        accounts.append(Account(account['amount'], account['interest'], account['type'], account['account_num']))
-                    return Client(current_client['bank_num'], current_client['n_accounts'], current_client['accounts'])
-                j -= 1
-            i -= 1
-        raise ValueError("Client not found")
+        try:
+            current_client = self.client_states[bank_num]
+        except KeyError:
+            raise ValueError("Client not found")
+
+        # A private copy, since callers change it
+        accounts = [copy_account(account) for account in current_client.accounts]
+        return Client(current_client.bank_num, current_client.n_accounts, accounts)
+
+    def view_client(self, bank_num) -> ClientView:
+        try:
+            return ClientView(self.client_states[bank_num])
+        except KeyError:
+            raise ValueError("Client not found")
+
+    def client_event(self, bank_num, op, account_num, **values):
+        event = {
+            'record': 'event',
+            'bank_num': bank_num,
+            'op': op,
+            'account_num': account_num,
+            **values
+        }
+        index = self.add_transaction('clients', event)
+
+        # A periodic full checkpoint bounds how many events a rebuild must fold.
+        # Writers are admitted with room for it when it falls due; if a racing
+        # writer to the same client took that room, the next event checkpoints
+        if self.client_events[bank_num] >= self.checkpoint_every and self.mempools['clients'].claim():
+            self.add_transaction('clients', self.get_client(bank_num).mapped)
+        return index
 
     def open_account(self, bank_num, principal, type):
-        client = self.get_client(bank_num)
-        interest = self.get_meta()['interest']
-        account = client.open_account(principal, interest, type)
+        with self.locks['clients']:
+            client = self.get_client(bank_num)
+            interest = self.get_meta()['interest']
+            account = client.open_account(principal, interest, type)
 
-        index = self.add_transaction('clients', client.mapped)
-        return account, index
+            index = self.client_event(bank_num, 'open', account.account_num, amount=account.amount, type=account.type, interest=account.interest)
+            return account, index
 
     def close_account(self, bank_num, account_num):
-        client = self.get_client(bank_num)
-        closed_account = client.close_account(account_num)
+        with self.locks['clients']:
+            # States are replaced, never changed, so the view still holds the closed account
+            closed_account = self.view_client(bank_num).get_account(account_num)
 
-        index = self.add_transaction('clients', client.mapped)
+            index = self.client_event(bank_num, 'close', account_num)
 
-        return closed_account, index
+            return closed_account, index
 
     def deposit(self, bank_num, account_num, amount):
-        client = self.get_client(bank_num)
-        account = client.get_account(account_num)
+        with self.locks['clients']:
+            account = self.view_client(bank_num).get_account(account_num)
 
-        new_amount = account.deposit(amount)
-        index = self.add_transaction('clients', client.mapped)
+            index = self.client_event(bank_num, 'deposit', account_num, amount=amount)
+
+            return account.amount + amount, index
 
-        return new_amount, index
-        
     def withdraw(self, bank_num, account_num, amount):
-        client = self.get_client(bank_num)
-        account = client.get_account(account_num)
+        with self.locks['clients']:
+            account = self.view_client(bank_num).get_account(account_num)
 
-        withdrawn = account.withdraw(amount)
-        index = self.add_transaction('clients', client.mapped)
+            # The event records the balance change, which for savings is less than requested
+            withdrawn = withdrawal(account.type, amount)
+            index = self.client_event(bank_num, 'withdraw', account_num, amount=withdrawn)
 
-        return withdrawn, index
+            return withdrawn, index
 
     def transfer(self, bank_num, account_num, recipient_num, amount):
-        client = self.get_client(bank_num)
-        sender = client.get_account(account_num)
-        receiver = client.get_account(recipient_num)
+        with self.locks['clients']:
+            client = self.view_client(bank_num)
+            sender = client.get_account(account_num)
+            client.get_account(recipient_num)
 
-        result = sender.transfer(receiver, amount)
-        index = self.add_transaction('clients', client.mapped)
+            check_transfer(sender.type)
+            index = self.client_event(bank_num, 'transfer', account_num, recipient_num=recipient_num, amount=amount)
 
-        return result, index
+            return {recipient_num: amount}, index
 
     def client_compound_interest(self):
-        for bank_num in self.clients:
-            client = self.get_client(bank_num)
-            for i in range(len(client.accounts)):
-                client.accounts[i].compound_interest()
-                index = self.add_transaction('clients', client.mapped)
-        return index
-    
\ No newline at end of file
+        # Month-end run: every account with a non-zero rate, compounded in one
+        # vectorized pass and recorded as a single batch transaction
+        with self.locks['clients']:
+            accounts = []
+            for bank_num, state in self.client_states.items():
+                account_nums = [account.account_num for account in state.accounts if account.interest]
+                if account_nums:
+                    accounts.append([bank_num, account_nums])
+
+            if not accounts:
+                return self.chains['clients'][-1]['index'] + 1
+            return self.add_transaction('clients', {'record': 'interest', 'accounts': accounts})
+
+    # ----------------------------------
+    #              Batches
+    # ----------------------------------
+
+    # Batch operation name -> (method, chain, required fields, optional fields).
+    # Fields are named as in the matching route's payload; required ones are
+    # passed in order, optional ones by name
+    OPERATIONS = {
+        'set_meta': ('set_meta', 'meta', ['interest', 'reserve_ratio'], []),
+        'borrow': ('borrow', 'finance', ['amount'], []),
+        'lend': ('lend', 'finance', ['amount'], []),
+        'interbank_compound': ('interbank_compound_interest', 'finance', [], []),
+        'buy_repo': ('buy_repo', 'finance', ['yield'], ['par']),
+        'sell_repo': ('sell_repo', 'finance', ['yield'], ['par']),
+        'add_employee': ('add_employee', 'hr', ['salary', 'department', 'supervisor_id'], []),
+        'add_client': ('add_client', 'clients', [], []),
+        'open': ('open_account', 'clients', ['bank_num', 'principal', 'type'], []),
+        'close': ('close_account', 'clients', ['bank_num', 'account_num'], []),
+        'deposit': ('deposit', 'clients', ['bank_num', 'account_num', 'amount'], []),
+        'withdraw': ('withdraw', 'clients', ['bank_num', 'account_num', 'amount'], []),
+        'transfer': ('transfer', 'clients', ['bank_num', 'account_num', 'recipient_num', 'amount'], []),
+        'client_compound': ('client_compound_interest', 'clients', [], [])
+    }
+    # Methods that record a client event, which may be followed by a full
+    # checkpoint of the client
+    CLIENT_EVENTS = {'open_account', 'close_account', 'deposit', 'withdraw', 'transfer'}
+
+    def admission(self, operations):
+        """
+        Mempool room a list of batch operations needs, per chain.
+
+        A client event that brings its client to checkpoint_every events is
+        followed by a checkpoint, so it needs a second slot. Operations that
+        aren't recognized need none; they simply fail.
+
+        :param operations: <list> dicts naming an 'op' and its arguments
+        :return: <Counter> transactions per chain type
+        """
+        counts = Counter()
+        events = {}
+        for operation in operations:
+            if not (isinstance(operation, dict) and isinstance(operation.get('op'), str) and operation['op'] in self.OPERATIONS):
+                continue
+            method, type = self.OPERATIONS[operation['op']][:2]
+            counts[type] += 1
+
+            bank_num = operation.get('bank_num')
+            if method in self.CLIENT_EVENTS and isinstance(bank_num, str):
+                n = events.get(bank_num, self.client_events.get(bank_num, 0)) + 1
+                if n >= self.checkpoint_every:
+                    counts[type] += 1
+                    n = 0
+                events[bank_num] = n
+        return counts
+
+    def apply_operation(self, operation):
+        try:
+            method, type, required, optional = self.OPERATIONS[operation['op']]
+        except (KeyError, TypeError):
+            raise ValueError("Unknown operation")
+        if not all(k in operation for k in required):
+            raise ValueError(f"Missing values for {operation['op']}")
+
+        args = [operation[k] for k in required]
+        kwargs = {k: operation[k] for k in optional if k in operation}
+        outcome = getattr(self, method)(*args, **kwargs)
+
+        # Methods return the new block index, or a (result, index) pair
+        if isinstance(outcome, tuple):
+            result, index = outcome
+            return getattr(result, 'mapped', result), {'chain': type, 'block': index}
+        return None, {'chain': type, 'block': outcome}
+
+    def apply_batch(self, operations, atomic=False):
+        """
+        Apply a list of typed operations in one pass.
+
+        Every operation is journaled so a failure leaves no partial trace.
+        With atomic set, the first failure also rolls back everything the
+        batch applied before it, and those operations are reported as
+        rolled back rather than with their results and receipts.
+
+        :param operations: <list> dicts naming an 'op' and its arguments
+        :param atomic: <bool> all-or-nothing
+        :return: <list> per-operation results, <bool> False if an atomic batch was rolled back
+        """
+        results = []
+        # The whole batch holds every chain lock, so no seal or other writer
+        # can interleave with it and a rollback only undoes its own work
+        with self.locked(*self.chains):
+            journal = Journal(self)
+            try:
+                for operation in operations:
+                    if not atomic:
+                        journal = Journal(self)
+                    self.journal = journal
+                    try:
+                        result, receipt = self.apply_operation(operation)
+                    except (ValueError, TypeError, KeyError, AttributeError) as e:
+                        with self.aggregates_lock:
+                            journal.rollback()
+                        if atomic:
+                            # Nothing before the failure took effect, so no receipts
+                            results = [{'ok': False, 'rolled_back': True} for _ in results]
+                            results.append({'ok': False, 'error': str(e)})
+                            return results, False
+                        results.append({'ok': False, 'error': str(e)})
+                        continue
+                    results.append({'ok': True, 'result': result, 'receipt': receipt})
+            finally:
+                self.journal = None
+        return results, True
@@ -2,6 +2,8 @@ from uuid import uuid4
 
 class Client:
 
+    __slots__ = ('bank_num', 'n_accounts', 'accounts')
+
     def __init__(self, bank_num, n_accounts=0, accounts=None):
         self.bank_num = bank_num
         self.n_accounts = n_accounts
@@ -20,7 +22,7 @@ class Client:
         if not (type == "checking" or type == "savings"):
             raise ValueError("Account type must be checking or savings")
         
-        self.accounts.append(Account(principal, 0, type))
+        self.accounts.append(Account(principal, interest, type))
         self.n_accounts += 1
         return self.accounts[-1]
 
@@ -43,14 +45,96 @@ class Client:
         #         "interest": account.interest,
         #     })
         return {
+            "record": "client",
             "bank_num": self.bank_num,
             "n_accounts": self.n_accounts,
             "accounts": [account.mapped for account in self.accounts]
         }
 
 
+def fold(state, event):
+    """
+    Apply a client event to a folded client state.
+
+    States are never changed in place: the result is a new state sharing
+    every untouched account with the old one, so a reader holding the old
+    state keeps a consistent snapshot.
+
+    :param state: <Client> folded client state
+    :param event: <dict> event recorded by Bank.client_event
+    :return: <Client> new state, <list> (account type, balance change) pairs
+    """
+    op = event['op']
+    accounts = list(state.accounts)
+    n_accounts = state.n_accounts
+
+    if op == 'open':
+        accounts.append(load_account(event))
+        n_accounts += 1
+        changes = [(event['type'], event['amount'])]
+    else:
+        position = account_position(accounts, event['account_num'])
+        account = accounts[position] = copy_account(accounts[position])
+        if op == 'close':
+            del accounts[position]
+            n_accounts -= 1
+            changes = [(account.type, -account.amount)]
+        elif op == 'deposit':
+            account.amount += event['amount']
+            changes = [(account.type, event['amount'])]
+        elif op == 'withdraw':
+            account.amount -= event['amount']
+            changes = [(account.type, -event['amount'])]
+        elif op == 'transfer':
+            account.amount -= event['amount']
+            position = account_position(accounts, event['recipient_num'])
+            recipient = accounts[position] = copy_account(accounts[position])
+            recipient.amount += event['amount']
+            changes = [(account.type, -event['amount']), (recipient.type, event['amount'])]
+        else:
+            raise ValueError(f"Unknown client event {op}")
+
+    return Client(state.bank_num, n_accounts, accounts), changes
+
+
+def load_client(record):
+    # Folded state from a client checkpoint or snapshot record
+    return Client(record['bank_num'], record['n_accounts'], [load_account(account) for account in record['accounts']])
+
+
+def load_account(record):
+    return Account(record['amount'], record['interest'], record['type'], record['account_num'])
+
+
+def copy_account(account):
+    return Account(account.amount, account.interest, account.type, account.account_num)
+
+
+def account_position(accounts, account_num):
+    for position, account in enumerate(accounts):
+        if account.account_num == account_num:
+            return position
+    raise ValueError("Account number doesn't match existing accounts.")
+
+
+def find_account(accounts, account_num):
+    return accounts[account_position(accounts, account_num)]
+
+
+def withdrawal(type, amount):
+    # Savings withdrawals only release 90% of the requested amount
+    return amount if type == "checking" else amount * 0.9
+
+
+def check_transfer(type):
+    if type == "savings":
+        raise AttributeError("Transfers are not allowed for savings accounts.")
+
+
 class Account:
 
+    __slots__ = ('amount', 'type', 'interest', 'account_num')
+
     def __init__(self, principal: float, interest: float, type: str, account_num=None):
         self.amount = principal
         self.type = type
@@ -69,16 +153,12 @@ class Account:
         return self.amount
 
     def withdraw(self, amount):
-        if self.type == "checking":
-            self.amount -= amount
-            return amount
-        else:
-            self.amount -= amount * 0.9
-            return amount * 0.9
+        withdrawn = withdrawal(self.type, amount)
+        self.amount -= withdrawn
+        return withdrawn
         
     def transfer(self, recipient, amount):
-        if self.type == "savings":
-            raise AttributeError("Transfers are not allowed for savings accounts.")
+        check_transfer(self.type)
         
         self.amount -= amount
         recipient.amount += amount
@@ -93,3 +173,62 @@ class Account:
             "type": self.type,
             "interest": self.interest
         }
+
+
+class ClientView:
+    """
+    Read-only view over a folded client state. Nothing is copied; states are
+    replaced rather than changed, so the view is a stable snapshot.
+    """
+
+    __slots__ = ('record',)
+
+    def __init__(self, record):
+        self.record = record
+
+    @property
+    def bank_num(self):
+        return self.record.bank_num
+
+    @property
+    def n_accounts(self):
+        return self.record.n_accounts
+
+    def get_account(self, account_num):
+        return AccountView(find_account(self.record.accounts, account_num))
+
+    @property
+    def mapped(self):
+        return {
+            'bank_num': self.record.bank_num,
+            'n_accounts': self.record.n_accounts,
+            'accounts': [account.mapped for account in self.record.accounts]
+        }
+
+
+class AccountView:
+
+    __slots__ = ('record',)
+
+    def __init__(self, record):
+        self.record = record
+
+    @property
+    def account_num(self):
+        return self.record.account_num
+
+    @property
+    def amount(self):
+        return self.record.amount
+
+    @property
+    def type(self):
+        return self.record.type
+
+    @property
+    def interest(self):
+        return self.record.interest
+
+    @property
+    def mapped(self):
+        return self.record.mapped
@@ -0,0 +1,257 @@
+import struct
+
+# Canonical binary encoding of blocks and transactions.
+#
+# Every document starts with a version byte, followed by one tagged value.
+# Dict keys are sorted, integers are zigzag varints, floats are big-endian
+# IEEE 754 doubles and lowercase hex strings (hashes, uuid4 hex numbers) are
+# stored as raw bytes, so the same value always encodes to the same bytes.
+# Field names from the ERP records are replaced by their position in KEYS;
+# the table is part of the version and must only change along with it.
+VERSION = 1
+MIMETYPE = 'application/x-erp-codec'
+
+NONE = ord('N')
+TRUE = ord('T')
+FALSE = ord('F')
+INT = ord('i')
+FLOAT = ord('f')
+STR = ord('s')
+HEX = ord('x')
+LIST = ord('l')
+DICT = ord('d')
+
+KEYS = (
+    'index', 'timestamp', 'transactions', 'proof', 'previous_hash', 'hash',
+    'interest', 'reserve_ratio', 'record', 'assets', 'liabilities', 'cash',
+    'portfolio', 'par', 'ytm', 'flag', 'employee_num', 'salary', 'department',
+    'supervisor_id', 'bank_num', 'n_accounts', 'accounts', 'account_num',
+    'amount', 'type',
+)
+KEY_IDS = {key: i for i, key in enumerate(KEYS)}
+
+# A float is its tag and the double packed in one call
+FLOAT_VALUE = struct.Struct('>Bd')
+
+
+class Encoded(bytes):
+    """
+    A document that was already encoded, embedded as is when it appears
+    inside another value, so a transaction is only encoded once on its way
+    from the mempool into a block.
+    """
+    __slots__ = ()
+
+
+def encode(value):
+    out = bytearray((VERSION,))
+    _encode(value, out)
+    return bytes(out)
+
+
+def decode(data):
+    value, position = decode_from(data, 0)
+    if position != len(data):
+        raise ValueError("Trailing bytes after encoded value")
+    return value
+
+
+def decode_from(data, position):
+    if not isinstance(data, bytes):
+        data = bytes(data)
+    if data[position] != VERSION:
+        raise ValueError(f"Unsupported codec version {data[position]}")
+    return _decode(data, position + 1)
+
+
+def decode_stream(data):
+    # Responses are sequences of whole documents laid end to end
+    position = 0
+    while position < len(data):
+        value, position = decode_from(data, position)
+        yield value
+
+
+def _varint(n, out):
+    while n > 0x7f:
+        out.append((n & 0x7f) | 0x80)
+        n >>= 7
+    out.append(n)
+
+
+def _varint_bytes(n):
+    out = bytearray()
+    _varint(n, out)
+    return bytes(out)
+
+
+# Even varints are KEYS positions, odd ones prefix a literal key's length
+KEY_PREFIXES = {key: _varint_bytes(i << 1) for i, key in enumerate(KEYS)}
+
+
+def _key(key, out):
+    prefix = KEY_PREFIXES.get(key)
+    if prefix is not None:
+        out += prefix
+        return
+    if not isinstance(key, str):
+        raise TypeError("Dict keys must be strings")
+    data = key.encode()
+    _varint((len(data) << 1) | 1, out)
+    out += data
+
+
+def _hex(value):
+    # Raw bytes of a lowercase hex string; the round trip is cheaper than a
+    # regex and rejects uppercase digits and whitespace alike
+    try:
+        raw = bytes.fromhex(value)
+    except ValueError:
+        return None
+    return raw if raw.hex() == value else None
+
+
+def _encode(value, out):
+    # Exact type checks first, most frequent in ERP records first; subclasses
+    # of the builtins fall through to the isinstance checks at the end
+    kind = type(value)
+    if kind is str:
+        raw = _hex(value) if len(value) >= 32 else None
+        if raw is not None:
+            out.append(HEX)
+            _varint(len(raw), out)
+            out += raw
+        else:
+            data = value.encode()
+            out.append(STR)
+            _varint(len(data), out)
+            out += data
+    elif kind is dict:
+        out.append(DICT)
+        _varint(len(value), out)
+        for key in sorted(value):
+            prefix = KEY_PREFIXES.get(key)
+            if prefix is None:
+                _key(key, out)
+            else:
+                out += prefix
+            _encode(value[key], out)
+    elif kind is int:
+        n = value << 1 if value >= 0 else (-value << 1) - 1
+        out.append(INT)
+        if n < 0x80:
+            out.append(n)
+        else:
+            _varint(n, out)
+    elif kind is float:
+        out += FLOAT_VALUE.pack(FLOAT, value)
+    elif kind is list or kind is tuple:
+        out.append(LIST)
+        _varint(len(value), out)
+        for item in value:
+            _encode(item, out)
+    elif kind is Encoded:
+        out += memoryview(value)[1:]
+    elif value is None:
+        out.append(NONE)
+    elif value is True:
+        out.append(TRUE)
+    elif value is False:
+        out.append(FALSE)
+    elif isinstance(value, int):
+        _encode(int(value), out)
+    elif isinstance(value, float):
+        _encode(float(value), out)
+    elif isinstance(value, str):
+        _encode(str(value), out)
+    elif isinstance(value, (list, tuple)):
+        _encode(list(value), out)
+    elif isinstance(value, dict):
+        _encode(dict(value), out)
+    else:
+        raise TypeError(f"Cannot encode {type(value).__name__}")
+
+
+def _read_varint(data, position):
+    n = shift = 0
+    while True:
+        byte = data[position]
+        position += 1
+        n |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return n, position
+        shift += 7
+
+
+def _decode(data, position):
+    # Single-byte varints, by far the most common, are read inline
+    tag = data[position]
+    position += 1
+
+    if tag == DICT:
+        count = data[position]
+        position += 1
+        if count & 0x80:
+            count, position = _read_varint(data, position - 1)
+        items = {}
+        for _ in range(count):
+            n = data[position]
+            position += 1
+            if n & 0x80:
+                n, position = _read_varint(data, position - 1)
+            if n & 1:
+                size = n >> 1
+                key = data[position:position + size].decode()
+                position += size
+            else:
+                key = KEYS[n >> 1]
+            # Leaf values with a single-byte length are read inline
+            tag = data[position]
+            if tag == STR or tag == HEX:
+                size = data[position + 1]
+                if size < 0x80:
+                    position += 2
+                    raw = data[position:position + size]
+                    items[key] = raw.decode() if tag == STR else raw.hex()
+                    position += size
+                    continue
+            elif tag == INT:
+                n = data[position + 1]
+                if n < 0x80:
+                    items[key] = (n >> 1) if not n & 1 else -((n + 1) >> 1)
+                    position += 2
+                    continue
+            items[key], position = _decode(data, position)
+        return items, position
+    if tag == STR or tag == HEX:
+        size = data[position]
+        position += 1
+        if size & 0x80:
+            size, position = _read_varint(data, position - 1)
+        raw = data[position:position + size]
+        return (raw.decode() if tag == STR else raw.hex()), position + size
+    if tag == INT:
+        n = data[position]
+        position += 1
+        if n & 0x80:
+            n, position = _read_varint(data, position - 1)
+        return (n >> 1) if not n & 1 else -((n + 1) >> 1), position
+    if tag == FLOAT:
+        return FLOAT_VALUE.unpack_from(data, position - 1)[1], position + 8
+    if tag == LIST:
+        count = data[position]
+        position += 1
+        if count & 0x80:
+            count, position = _read_varint(data, position - 1)
+        items = []
+        for _ in range(count):
+            item, position = _decode(data, position)
+            items.append(item)
+        return items, position
+    if tag == NONE:
+        return None, position
+    if tag == TRUE:
+        return True, position
+    if tag == FALSE:
+        return False, position
+    raise ValueError(f"Unknown tag {tag!r}")
@@ -0,0 +1,32 @@
+import numpy as np
+
+
+def compound(accounts):
+    """
+    Compound interest on many accounts in one vectorized pass.
+
+    Balances and rates are gathered into float64 arrays, multiplied once and
+    written back, which gives the same results as compounding each Account
+    on its own.
+
+    :param accounts: <list> Account objects, updated in place
+    :return: <dict> total balance change per account type
+    """
+    if not accounts:
+        return {}
+
+    count = len(accounts)
+    amounts = np.fromiter((account.amount for account in accounts), dtype=np.float64, count=count)
+    rates = np.fromiter((account.interest for account in accounts), dtype=np.float64, count=count)
+    savings = np.fromiter((account.type == 'savings' for account in accounts), dtype=bool, count=count)
+
+    compounded = amounts * (1 + rates)
+    changes = compounded - amounts
+
+    for account, amount in zip(accounts, compounded.tolist()):
+        account.amount = amount
+
+    return {
+        'savings': float(changes[savings].sum()),
+        'checking': float(changes[~savings].sum())
+    }
@@ -1,5 +1,7 @@
 class Employee:
 
+    __slots__ = ('employee_num', 'salary', 'department', 'supervisor_id')
+
     def __init__(self, employee_num, salary, department, supervisor_id):
         self.employee_num = employee_num
         self.salary = salary
@@ -14,3 +16,87 @@ class Employee:
             'department': self.department,
             'supervisor_id': self.supervisor_id
         }
+
+
+def load_employee(record):
+    return Employee(record['employee_num'], record['salary'], record['department'], record['supervisor_id'])
+
+
+class EmployeeView:
+
+    # Read-only view over the resident employee, which is replaced on every
+    # hr record rather than changed
+    __slots__ = ('record',)
+
+    def __init__(self, record):
+        self.record = record
+
+    @property
+    def employee_num(self):
+        return self.record.employee_num
+
+    @property
+    def salary(self):
+        return self.record.salary
+
+    @property
+    def department(self):
+        return self.record.department
+
+    @property
+    def supervisor_id(self):
+        return self.record.supervisor_id
+
+    @property
+    def mapped(self):
+        return self.record.mapped
+
+
+class Directory:
+
+    def __init__(self):
+        self.employees = {}
+        # Secondary indexes map a key to an insertion-ordered set of employee numbers
+        self.departments = {}
+        self.reports = {}
+
+    def update(self, employee):
+        employee_num = employee.employee_num
+        previous = self.employees.get(employee_num)
+        if previous is not None:
+            self.departments[previous.department].pop(employee_num, None)
+            self.reports[previous.supervisor_id].pop(employee_num, None)
+
+        self.employees[employee_num] = employee
+        self.departments.setdefault(employee.department, {})[employee_num] = None
+        self.reports.setdefault(employee.supervisor_id, {})[employee_num] = None
+
+    def remove(self, employee_num):
+        employee = self.employees.pop(employee_num, None)
+        if employee is not None:
+            self.departments[employee.department].pop(employee_num, None)
+            self.reports[employee.supervisor_id].pop(employee_num, None)
+
+    def get(self, employee_num):
+        try:
+            return self.employees[employee_num]
+        except KeyError:
+            raise ValueError("Invalid employee number.")
+
+    def roster(self, department):
+        return [self.employees[employee_num].mapped for employee_num in self.departments.get(department, {})]
+
+    def reporting_tree(self, employee_num):
+        root = {'employee': self.get(employee_num).mapped, 'reports': []}
+        seen = {employee_num}
+        stack = [root]
+        while stack:
+            node = stack.pop()
+            for report_num in self.reports.get(node['employee']['employee_num'], {}):
+                if report_num in seen:  # Guard against supervisor cycles
+                    continue
+                seen.add(report_num)
+                child = {'employee': self.employees[report_num].mapped, 'reports': []}
+                node['reports'].append(child)
+                stack.append(child)
+        return root
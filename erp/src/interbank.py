@@ -1,5 +1,7 @@
 class InterbankLoanPortfolio:
 
+    __slots__ = ('assets', 'liabilities', 'cash', 'interest')
+
     def __init__(self, interest, assets=0, liabilities=0, cash=0):
         self.assets = assets
         self.liabilities = liabilities
@@ -28,6 +30,7 @@ class InterbankLoanPortfolio:
     @property
     def mapped(self):
         return {
+            'record': 'interbank',
             'assets': self.assets,
             'liabilities': self.liabilities,
             'cash': self.cash,
@@ -0,0 +1,89 @@
+# Running totals fed by each chain; a journal over some chains restores only theirs
+TOTALS = {
+    'meta': (),
+    'finance': ('repo', 'cash', 'liabilities'),
+    'hr': ('payroll',),
+    'clients': ('deposits',)
+}
+
+
+class Journal:
+    """
+    Undo log for the transactions a Bank accepts while it is active.
+
+    Small pieces of state (pending lengths, mempool depths, meta, finance
+    heads, aggregates) are saved up front; client states and employee
+    records are saved the first time a transaction touches them, so a
+    rollback costs only what the journaled transactions changed. Both are
+    replaced rather than changed in place, so saving one is keeping a
+    reference.
+
+    A journal can cover only some chains. Each chain feeds its own part of
+    the state, so rolling back one chain's transactions leaves the others'
+    untouched.
+    """
+
+    def __init__(self, bank, types=None):
+        self.bank = bank
+        self.types = list(bank.chains) if types is None else list(types)
+        self.pending = {type: len(bank.current_transactions[type]) for type in self.types}
+        self.depths = {type: (bank.mempools[type].count, bank.mempools[type].bytes) for type in self.types}
+        self.meta = bank.meta
+        self.finance_heads = dict(bank.finance_heads)
+        self.aggregates = bank.aggregates.mapped
+        self.n_clients = len(bank.clients)
+        self.n_employees = len(bank.employees)
+
+        # Value before the first touch, or None for entries created since
+        self.client_states = {}
+        self.client_events = {}
+        self.employees = {}
+
+    def record(self, type, data):
+        # Called before the transaction is indexed
+        if type == 'clients':
+            if data.get('record') == 'interest':
+                bank_nums = [bank_num for bank_num, _ in data['accounts']]
+            else:
+                bank_nums = [data['bank_num']]
+            for bank_num in bank_nums:
+                if bank_num not in self.client_states:
+                    self.client_states[bank_num] = self.bank.client_states.get(bank_num)
+                    self.client_events[bank_num] = self.bank.client_events.get(bank_num)
+        elif type == 'hr':
+            employee_num = data['employee_num']
+            if employee_num not in self.employees:
+                self.employees[employee_num] = self.bank.directory.employees.get(employee_num)
+
+    def rollback(self):
+        bank = self.bank
+        for type, length in self.pending.items():
+            del bank.current_transactions[type][length:]
+            del bank.encoded_transactions[type][length:]
+            bank.mempools[type].restore(*self.depths[type])
+            for total in TOTALS[type]:
+                value = self.aggregates[total]
+                setattr(bank.aggregates, total, dict(value) if isinstance(value, dict) else value)
+
+        if 'meta' in self.types:
+            bank.meta = self.meta
+        if 'finance' in self.types:
+            bank.finance_heads = dict(self.finance_heads)
+
+        if 'clients' in self.types:
+            del bank.clients[self.n_clients:]
+            for bank_num, state in self.client_states.items():
+                if state is None:
+                    bank.client_states.pop(bank_num, None)
+                    bank.client_events.pop(bank_num, None)
+                else:
+                    bank.client_states[bank_num] = state
+                    bank.client_events[bank_num] = self.client_events[bank_num]
+
+        if 'hr' in self.types:
+            del bank.employees[self.n_employees:]
+            for employee_num, record in self.employees.items():
+                if record is None:
+                    bank.directory.remove(employee_num)
+                else:
+                    bank.directory.update(record)
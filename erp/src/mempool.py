@@ -0,0 +1,133 @@
+import threading
+
+from time import time
+
+
+class MempoolFull(Exception):
+    pass
+
+
+class RequestTooLarge(Exception):
+    # More transactions than the pool can ever hold, so retrying can't help
+    pass
+
+
+class Mempool:
+    """
+    Bounds on one chain's pending transactions, by count and encoded bytes.
+
+    Writers are admitted before they take the chain lock: reserve() either
+    rejects at once or, with the block policy, waits up to timeout seconds
+    for a seal to make room. Reservations count against the limits until
+    the write finishes, so concurrent writers can't all slip past a nearly
+    full pool. add() and clear() keep the depth in step with the pending list;
+    an add() by a thread holding a reservation uses up one of its slots.
+    """
+
+    def __init__(self, max_count=10000, max_bytes=16 * 1024 * 1024, policy='reject', timeout=5.0):
+        if policy not in ('reject', 'block'):
+            raise ValueError("Overflow policy must be reject or block")
+        self.max_count = max_count
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self.timeout = timeout
+
+        self.count = 0
+        self.bytes = 0
+        self.reserved = 0
+        # Unused reserved slots per thread holding them
+        self.holders = {}
+        self.rejected = 0
+        self.waited = 0
+        self.peak = 0
+        self.changed = threading.Condition()
+
+    def full(self, n=1):
+        return self.count + self.reserved + n > self.max_count or self.bytes >= self.max_bytes
+
+    def reserve(self, n=1):
+        with self.changed:
+            if n > self.max_count:
+                self.rejected += 1
+                raise RequestTooLarge(f"{n} transactions can never fit in a pool of {self.max_count}")
+            if self.full(n):
+                if self.policy == 'block':
+                    self.waited += 1
+                    deadline = time() + self.timeout
+                    while self.full(n) and time() < deadline:
+                        self.changed.wait(deadline - time())
+                if self.full(n):
+                    self.rejected += 1
+                    raise MempoolFull("Pending transactions are at capacity")
+            self.reserved += n
+            holder = threading.get_ident()
+            self.holders[holder] = self.holders.get(holder, 0) + n
+
+    def release(self, n=1):
+        # Gives back whatever of the reservation the writer didn't use
+        with self.changed:
+            holder = threading.get_ident()
+            unused = min(n, self.holders.get(holder, 0))
+            self.held(holder, unused)
+            self.changed.notify_all()
+
+    def claim(self):
+        """
+        Make sure the calling thread has a slot for one more transaction,
+        taking it from free room if its own reservation is used up.
+
+        :return: <bool> False if the pool has no room
+        """
+        with self.changed:
+            holder = threading.get_ident()
+            if self.holders.get(holder, 0):
+                return True
+            if self.full(1):
+                return False
+            self.reserved += 1
+            self.holders[holder] = 1
+            return True
+
+    def held(self, holder, n):
+        # Drop n of a holder's unused slots; callers hold the condition
+        self.reserved -= n
+        left = self.holders.get(holder, 0) - n
+        if left > 0:
+            self.holders[holder] = left
+        else:
+            self.holders.pop(holder, None)
+
+    def add(self, size):
+        with self.changed:
+            holder = threading.get_ident()
+            if self.holders.get(holder, 0):
+                self.held(holder, 1)
+            self.count += 1
+            self.bytes += size
+            self.peak = max(self.peak, self.count)
+
+    def restore(self, count, size):
+        # Back to an earlier depth, after a batch rollback
+        with self.changed:
+            self.count, self.bytes = count, size
+            self.changed.notify_all()
+
+    def clear(self):
+        with self.changed:
+            self.count = 0
+            self.bytes = 0
+            self.changed.notify_all()
+
+    @property
+    def mapped(self):
+        return {
+            'count': self.count,
+            'bytes': self.bytes,
+            'reserved': self.reserved,
+            'max_count': self.max_count,
+            'max_bytes': self.max_bytes,
+            'policy': self.policy,
+            'peak': self.peak,
+            'rejected': self.rejected,
+            'waited': self.waited
+        }
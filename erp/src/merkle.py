@@ -0,0 +1,72 @@
+import hashlib
+
+from . import codec
+
+# Domain-separation prefixes, so a leaf can never be passed off as an inner node
+LEAF = b'\x00'
+NODE = b'\x01'
+
+
+def leaf_hash(transaction):
+    # Transactions may come already encoded, as the mempool keeps them
+    if not isinstance(transaction, codec.Encoded):
+        transaction = codec.encode(transaction)
+    return hashlib.sha256(LEAF + transaction).digest()
+
+
+def node_hash(left, right):
+    return hashlib.sha256(NODE + left + right).digest()
+
+
+def levels(transactions):
+    # Every level of the tree from the leaves up; an unpaired last node is
+    # promoted to the next level unchanged
+    level = [leaf_hash(transaction) for transaction in transactions]
+    tree = [level]
+    while len(level) > 1:
+        level = [
+            node_hash(level[i], level[i + 1]) if i + 1 < len(level) else level[i]
+            for i in range(0, len(level), 2)
+        ]
+        tree.append(level)
+    return tree
+
+
+def merkle_root(transactions):
+    if not transactions:
+        return hashlib.sha256(b'').hexdigest()
+    return levels(transactions)[-1][0].hex()
+
+
+def valid_root(block):
+    # Blocks sealed before merkle roots hash their transactions directly
+    return 'merkle_root' not in block or merkle_root(block['transactions']) == block['merkle_root']
+
+
+def inclusion_proof(transactions, position):
+    """
+    Sibling hashes linking one transaction to the root of its block.
+
+    :param transactions: <list> transactions of the block
+    :param position: <int> position of the transaction in the block
+    :return: <list> [side, hash] pairs from the leaf up, side being where the sibling sits
+    """
+    if not 0 <= position < len(transactions):
+        raise ValueError("Transaction position out of range")
+
+    proof = []
+    for level in levels(transactions)[:-1]:
+        if position % 2:
+            proof.append(['left', level[position - 1].hex()])
+        elif position + 1 < len(level):
+            proof.append(['right', level[position + 1].hex()])
+        position //= 2
+    return proof
+
+
+def verify_proof(transaction, proof, root):
+    digest = leaf_hash(transaction)
+    for side, sibling in proof:
+        sibling = bytes.fromhex(sibling)
+        digest = node_hash(sibling, digest) if side == 'left' else node_hash(digest, sibling)
+    return digest.hex() == root
@@ -0,0 +1,212 @@
+import hashlib
+import os
+import threading
+
+from multiprocessing import Array, Pool
+from queue import Queue
+from time import time
+
+from .merkle import valid_root
+
+# Each concurrent search owns one slot in the shared array of found proofs
+SLOTS = 16
+NOT_FOUND = 1 << 62
+CHECK_EVERY = 1024
+# Leading zero bits required of a proof's hash; 16 matches four hex zeroes
+DIFFICULTY = 16
+
+_found = None
+
+
+def prefix(last_proof, last_hash):
+    # The guess is last_proof + last_hash + proof, so everything but the proof
+    # can be hashed once per search and reused through copy()
+    return hashlib.sha256(f'{last_proof}{last_hash}'.encode())
+
+
+def target(difficulty):
+    return 1 << (256 - difficulty)
+
+
+def valid_proof(last_proof, proof, last_hash, difficulty=DIFFICULTY):
+    """
+    Check if proof meets the target
+    """
+    guess = prefix(last_proof, last_hash)
+    guess.update(b'%d' % proof)
+
+    return int.from_bytes(guess.digest(), 'big') < target(difficulty)
+
+
+def _init_worker(found):
+    global _found
+    _found = found
+
+
+def _search(slot, last_proof, last_hash, difficulty, start, stop):
+    base = prefix(last_proof, last_hash)
+    limit = target(difficulty)
+    for proof in range(start, stop):
+        # Give up once another worker has a proof lower than anything left here
+        if proof % CHECK_EVERY == 0 and _found[slot] < start:
+            return None, proof - start
+        guess = base.copy()
+        guess.update(b'%d' % proof)
+        if int.from_bytes(guess.digest(), 'big') < limit:
+            with _found.get_lock():
+                if proof < _found[slot]:
+                    _found[slot] = proof
+            return proof, proof - start + 1
+    return None, stop - start
+
+
+def _sequential_search(last_proof, last_hash, difficulty):
+    base = prefix(last_proof, last_hash)
+    limit = target(difficulty)
+    proof = 0
+    while True:
+        guess = base.copy()
+        guess.update(b'%d' % proof)
+        if int.from_bytes(guess.digest(), 'big') < limit:
+            return proof, proof + 1
+        proof += 1
+
+
+class Miner:
+
+    def __init__(self, workers=None, difficulty=DIFFICULTY, chunk_size=20000):
+        self.workers = workers or os.cpu_count() or 1
+        self.difficulty = difficulty
+        self.chunk_size = chunk_size
+        self.pool = None
+        self.found = None
+
+        # Hashes tried and seconds spent, summed over every search
+        self.hashes = 0
+        self.seconds = 0
+        self.stats_lock = threading.Lock()
+        self.pool_lock = threading.Lock()
+
+        self.slots = Queue()
+        for slot in range(SLOTS):
+            self.slots.put(slot)
+
+    def start(self):
+        # Concurrent seals may race to create the pool; they must share one
+        with self.pool_lock:
+            if self.pool is None:
+                self.found = Array('q', SLOTS)
+                self.pool = Pool(self.workers, initializer=_init_worker, initargs=(self.found,))
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+
+    def proof_of_work(self, last_proof, last_hash):
+        """
+        Search nonces in consecutive chunks spread over the worker pool.
+
+        Chunks are handed out a batch at a time and every chunk below the
+        first hit runs to completion, so the result is always the lowest
+        valid proof, the same one a single-core search would find.
+
+        :param last_proof: <int> proof of the last block
+        :param last_hash: <str> hash of the last block
+        :return: <int>
+        """
+        started = time()
+        if self.workers == 1:
+            proof, hashes = _sequential_search(last_proof, last_hash, self.difficulty)
+        else:
+            proof, hashes = self._parallel_search(last_proof, last_hash)
+        self.record(hashes, time() - started)
+        return proof
+
+    def _parallel_search(self, last_proof, last_hash):
+        self.start()
+        slot = self.slots.get()
+        try:
+            self.found[slot] = NOT_FOUND
+            start = 0
+            hashes = 0
+            span = self.chunk_size * self.workers
+            while True:
+                batch = [
+                    self.pool.apply_async(_search, (slot, last_proof, last_hash, self.difficulty, chunk, chunk + self.chunk_size))
+                    for chunk in range(start, start + span, self.chunk_size)
+                ]
+                results = [result.get() for result in batch]
+                hashes += sum(tried for _, tried in results)
+                proofs = [proof for proof, _ in results if proof is not None]
+                if proofs:
+                    return min(proofs), hashes
+                start += span
+        finally:
+            self.slots.put(slot)
+
+    def record(self, hashes, seconds):
+        with self.stats_lock:
+            self.hashes += hashes
+            self.seconds += seconds
+
+    @property
+    def hash_rate(self):
+        if self.seconds == 0:
+            return 0
+        return self.hashes / self.seconds
+
+    def verify(self, chain, compute_hash):
+        """
+        Check every link of chain, including its proofs of work.
+
+        The chain is cut into segments that overlap by one block and each
+        segment is checked on the worker pool.
+
+        :param chain: <list> blocks to check
+        :param compute_hash: function hashing a block from its contents
+        :return: <int> index of the first invalid block, or None
+        """
+        chain = list(chain)
+        if self.workers == 1 or len(chain) < 2 * self.workers:
+            return _verify_segment(chain, 0, compute_hash, self.difficulty)
+
+        self.start()
+        size = -(-len(chain) // (self.workers * 4))
+        results = [
+            self.pool.apply_async(_verify_segment, (chain[max(start - 1, 0):start + size], max(start - 1, 0), compute_hash, self.difficulty))
+            for start in range(0, len(chain), size)
+        ]
+        failures = [index for index in (result.get() for result in results) if index is not None]
+        return min(failures) if failures else None
+
+    @property
+    def mapped(self):
+        return {
+            'workers': self.workers,
+            'difficulty': self.difficulty,
+            'hashes': self.hashes,
+            'seconds': self.seconds,
+            'hash_rate': self.hash_rate
+        }
+
+
+def _verify_segment(blocks, offset, compute_hash, difficulty):
+    # blocks[0] is the last block of the previous segment (or genesis), so the
+    # first link of this segment can be checked without any other context
+    last_block_hash = compute_hash(blocks[0])
+    if offset == 0 and (blocks[0].get('hash', last_block_hash) != last_block_hash or not valid_root(blocks[0])):
+        return 0
+
+    for i in range(1, len(blocks)):
+        block = blocks[i]
+        block_hash = compute_hash(block)
+        if block.get('hash', block_hash) != block_hash or not valid_root(block):
+            return offset + i
+        if block['previous_hash'] != last_block_hash:
+            return offset + i
+        if not valid_proof(blocks[i - 1]['proof'], block['proof'], last_block_hash, difficulty):
+            return offset + i
+        last_block_hash = block_hash
+    return None
@@ -1,56 +1,47 @@
 class RepoPortfolio:
 
-    def __init__(self, portfolio=None):
-        if portfolio is None:
-            self.portfolio = []
+    __slots__ = ('number', 'reserves', 'present_value')
+
+    # Running position over every trade; individual trades live on the chain
+    def __init__(self, number=0, reserves=0, present_value=0, portfolio=None):
+        self.number = number
+        self.reserves = reserves
+        self.present_value = present_value
+
+        if portfolio is not None:
+            for bond in portfolio:
+                self.add(bond)
+
+    def add(self, bond):
+        self.number += 1
+        if bond.flag == "buy":
+            self.reserves -= bond.par
+            self.present_value -= bond.present_value
         else:
-            self.portfolio = portfolio
-    
-    @property
-    def number(self):
-        return len(self.portfolio)
-    
-    @property
-    def reserves(self):
-        value = 0
-
-        for bond in self.portfolio:
-            if bond.flag == "buy":
-                value -= bond.par
-            else:
-                value += bond.par
-
-        return value
-
-    @property
-    def present_value(self):
-        pv = 0
-
-        for bond in self.portfolio:
-            if bond.flag == "buy":
-                pv -= bond.present_value
-            else:
-                pv += bond.present_value
-        
-        return pv
+            self.reserves += bond.par
+            self.present_value += bond.present_value
+        return bond
 
     def buy_repo(self, ytm, par):
-        self.portfolio.append(Repo(ytm, "buy", par))
-        return self.portfolio[-1]
+        return self.add(Repo(ytm, "buy", par))
     
     def sell_repo(self, ytm, par):
-        self.portfolio.append(Repo(ytm, "sell", par))
-        return self.portfolio[-1]
+        return self.add(Repo(ytm, "sell", par))
 
     @property
     def mapped(self):
         return {
-            'portfolio': [repo.mapped for repo in self.portfolio],
+            'record': 'repo',
+            'number': self.number,
+            'reserves': self.reserves,
+            'present_value': self.present_value
         }
 
 
 class Repo:
 
+    __slots__ = ('par', 'ytm', 'flag')
+
     def __init__(self, ytm, flag, par):
         self.par = par
         self.ytm = ytm
@@ -0,0 +1,60 @@
+class Reserves:
+
+    def __init__(self, deposits=None, payroll=0, repo=0, cash=0, liabilities=0):
+        if deposits is None:
+            self.deposits = {
+                'checking': 0,
+                'savings': 0
+            }
+        else:
+            self.deposits = dict(deposits)
+        self.payroll = payroll
+        self.repo = repo
+        self.cash = cash
+        self.liabilities = liabilities
+
+    def update_client(self, previous, current):
+        if previous is not None:
+            for account in previous.accounts:
+                self.deposits[account.type] -= account.amount
+        for account in current.accounts:
+            self.deposits[account.type] += account.amount
+
+    def update_deposit(self, type, change):
+        self.deposits[type] += change
+
+    def update_employee(self, previous, current):
+        if previous is not None:
+            self.payroll -= previous.salary
+        self.payroll += current.salary
+
+    def update_interbank(self, interbank):
+        self.cash = interbank.cash
+        self.liabilities = interbank.liabilities
+
+    def update_repo(self, portfolio):
+        self.repo = portfolio.reserves
+
+    @property
+    def client_deposits(self):
+        return self.deposits['checking'] + self.deposits['savings']
+
+    @property
+    def total(self):
+        return self.cash + self.repo + self.client_deposits - self.payroll
+
+    def ratio_met(self, reserve_ratio):
+        base = self.client_deposits + self.repo
+        if base == 0:
+            return self.liabilities <= 0
+        return (base - self.liabilities) / base >= reserve_ratio
+
+    @property
+    def mapped(self):
+        return {
+            'deposits': dict(self.deposits),
+            'payroll': self.payroll,
+            'repo': self.repo,
+            'cash': self.cash,
+            'liabilities': self.liabilities
+        }
@@ -1,7 +1,13 @@
 from .bank import Bank
+from .mempool import MempoolFull, RequestTooLarge
+from . import codec
 
+import itertools
+import json
+
+from functools import wraps
 from uuid import uuid4
-from flask import Blueprint, jsonify, request
+from flask import Blueprint, Response, jsonify, request, stream_with_context
 
 erp = Blueprint('erp', __name__)
 
@@ -9,6 +15,30 @@ node_identifier = str(uuid4()).replace('-', '')
 
 bank = Bank()
 
+def admits(type, op=None):
+    # Writers get room in the chain's mempool before the bank takes any lock;
+    # routes that mirror a batch operation are admitted the way it would be
+    def decorator(view):
+        @wraps(view)
+        def admitted(*args, **kwargs):
+            values = request.get_json(silent=True)
+            if op is not None and isinstance(values, dict):
+                counts = bank.admission([{**values, 'op': op}])
+            else:
+                counts = {type: 1}
+            with bank.admit(counts):
+                return view(*args, **kwargs)
+        return admitted
+    return decorator
+
+@erp.errorhandler(MempoolFull)
+def mempool_full(error):
+    return str(error), 503, {'Retry-After': '1'}
+
+@erp.errorhandler(RequestTooLarge)
+def request_too_large(error):
+    return str(error), 413
+
 @erp.route('/')
 def home():
     return "<h1>Blockchain ERP System</h1>"
@@ -19,57 +49,224 @@ def home():
 
 @erp.route('/mine', methods=['GET'])
 def mine():
-    blocks = []
-    for type in ['meta', 'finance', 'hr', 'clients']:
-        if bank.current_transactions[type]:
-            last_block = bank.chains[type][-1]
-            print(last_block)
-            proof = bank.proof_of_work(last_block)
-            previous_hash = bank.hash(last_block)
-            block = bank.add_block(type, proof, previous_hash)
+    blocks = bank.mine()
 
     response = {
-        'message': "New blocks forged"
+        'message': "New blocks forged" if blocks else "No pending transactions",
+        'blocks': {},
+        'hash_rate': bank.miner.hash_rate
     }
-    for block in blocks:
-        response.update(
-            {'block': 
-                {
-                    'index': block['index'],
-                    'transactions': block['transactions'],
-                    'proof': block['proof'],  
-                    'previous_hash': block['previous_hash']
-                }
-            })
+    for type, block in blocks.items():
+        response['blocks'][type] = {
+            'index': block['index'],
+            'transactions': block['transactions'],
+            'proof': block['proof'],
+            'previous_hash': block['previous_hash'],
+            'merkle_root': block['merkle_root'],
+            'hash': block['hash']
+        }
 
     return jsonify(response), 200
 
+@erp.route('/mine/stats', methods=['GET'])
+def mining_stats():
+    return jsonify(bank.miner.mapped), 200
+
+def chain_range(length):
+    # Blocks [start, stop) selected by the start/cursor, end and limit arguments
+    start = max(request.args.get('cursor', request.args.get('start', 0, type=int), type=int), 0)
+    end = request.args.get('end', None, type=int)
+    limit = request.args.get('limit', None, type=int)
+
+    stop = length if end is None else min(end, length)
+    if limit is not None:
+        stop = min(stop, start + max(limit, 0))
+    return start, max(stop, start)
+
+def stream_blocks(chain, start, stop):
+    # Read one block at a time so a full dump never holds the chain in memory
+    for position in range(start, stop):
+        yield chain[position]
+
+def stream_ndjson(lines):
+    for line in lines:
+        yield json.dumps(line) + '\n'
+
+def stream_document(fields, arrays):
+    # Chunked JSON with the same shape as the buffered response
+    separator = ''
+    yield '{'
+    for key, value in fields.items():
+        yield f'{separator}{json.dumps(key)}: {json.dumps(value)}'
+        separator = ', '
+    for key, blocks in arrays:
+        yield f'{separator}{json.dumps(key)}: ['
+        comma = ''
+        for block in blocks:
+            yield comma + json.dumps(block)
+            comma = ', '
+        yield ']'
+        separator = ', '
+    yield '}'
+
+def wants_ndjson():
+    return request.args.get('format') == 'ndjson' or request.accept_mimetypes.best == 'application/x-ndjson'
+
+def wants_binary():
+    return request.args.get('format') == 'binary' or request.accept_mimetypes.best == codec.MIMETYPE
+
+def stream_binary(documents):
+    # Encoded documents laid end to end; each one is self-delimiting
+    for document in documents:
+        yield codec.encode(document)
+
 @erp.route('/chains', methods=['GET'])
 def full_chain():
+    # Lengths are fixed up front so blocks sealed mid-stream are left out
+    chains = {type: bank.chain_snapshot(type) for type in ['meta', 'finance', 'hr', 'clients']}
+    lengths = {type: len(chain) for type, chain in chains.items()}
+
+    lines = (
+        {'type': type, 'block': block}
+        for type, length in lengths.items()
+        for block in stream_blocks(chains[type], 0, length)
+    )
+    if wants_binary():
+        return Response(stream_with_context(stream_binary(lines)), mimetype=codec.MIMETYPE), 200
+    if wants_ndjson():
+        return Response(stream_with_context(stream_ndjson(lines)), mimetype='application/x-ndjson'), 200
+
+    arrays = [(type, stream_blocks(chains[type], 0, length)) for type, length in lengths.items()]
+    return Response(stream_with_context(stream_document({}, arrays)), mimetype='application/json'), 200
+
+@erp.route('/chains/<type>', methods=['GET'])
+def chain(type):
+    if type not in bank.chains:
+        return "Chain type not recognized", 404
+
+    chain = bank.chain_snapshot(type)
+    length = len(chain)
+    start, stop = chain_range(length)
+    blocks = stream_blocks(chain, start, stop)
+
+    if wants_ndjson():
+        return Response(stream_with_context(stream_ndjson(blocks)), mimetype='application/x-ndjson'), 200
+
+    fields = {
+        'start': start,
+        'length': length,
+        'next': stop if stop < length else None
+    }
+    if wants_binary():
+        documents = itertools.chain([fields], blocks)
+        return Response(stream_with_context(stream_binary(documents)), mimetype=codec.MIMETYPE), 200
+    if 'limit' not in request.args and 'end' not in request.args:
+        return Response(stream_with_context(stream_document(fields, [('chain', blocks)])), mimetype='application/json'), 200
+
+    response = dict(fields, chain=list(blocks))
+    return jsonify(response), 200
+
+@erp.route('/chains/<type>/locate', methods=['POST'])
+def locate(type):
+    if type not in bank.chains:
+        return "Chain type not recognized", 404
+
+    values = request.get_json()
+    if values is None or 'locator' not in values:
+        return "Missing values", 400
+
     response = {
-            'meta': bank.chains['meta'],
-            'finance': bank.chains['finance'],
-            'hr': bank.chains['hr'],
-            'clients': bank.chains['clients']
+        'ancestor': bank.find_ancestor(type, values['locator']),
+        'length': len(bank.chains[type])
     }
     return jsonify(response), 200
 
-@erp.route('/chains/<type>', methods=['GET'])
-def chain(type):
+@erp.route('/chains/<type>/<int:index>/proofs/<int:position>', methods=['GET'])
+def transaction_proof(type, index, position):
+    # Enough to check one transaction against the block hash: rebuild the
+    # root from the leaf and the path, then hash the header that holds it
+    if type not in bank.chains:
+        return "Chain type not recognized", 404
+
+    try:
+        response = bank.transaction_proof(type, index, position)
+    except ValueError as e:
+        return str(e), 404
+
+    response['chain'] = type
+    return jsonify(response), 200
+
+@erp.route('/chains/validate', methods=['GET'])
+def validate_chains():
+    full = request.args.get('full', 'false').lower() in ('1', 'true', 'yes')
+
+    response = {
+        'valid': {type: bank.validate_chain(type, bank.chains[type], full) for type in bank.chains},
+        'verified': bank.verified,
+        'full': full
+    }
+    return jsonify(response), 200
+
+@erp.route('/chains/audit', methods=['GET'])
+def audit_chains():
+    first_invalid = bank.audit()
+
+    response = {
+        'valid': all(index is None for index in first_invalid.values()),
+        'first_invalid': first_invalid
+    }
+    return jsonify(response), 200
+
+def receipt(type, index):
+    # Where a write will land; poll or await it at /receipts/<chain>/<block>
+    return {'chain': type, 'block': index}
+
+@erp.route('/receipts/<type>/<int:index>', methods=['GET'])
+def await_receipt(type, index):
+    if type not in bank.chains:
+        return "Chain type not recognized", 404
+    if index < 1:
+        return "Invalid block index", 400
+
+    # wait=0 polls; otherwise block for up to that many seconds
+    wait = min(max(request.args.get('wait', 0, type=float), 0), 60)
+    block = bank.await_block(type, index, wait)
+
     response = {
-        'chain': bank.chains[type]
+        'chain': type,
+        'block': index,
+        'sealed': block is not None
     }
+    if block is not None:
+        response['hash'] = block['hash']
     return jsonify(response), 200
 
 @erp.route('/transactions', methods=['GET'])
 def full_transactions():
+    return jsonify(bank.pending()), 200
+
+@erp.route('/transactions/stats', methods=['GET'])
+def mempool_stats():
+    return jsonify(bank.mempool_stats()), 200
+
+@erp.route('/transactions/batch', methods=['POST'])
+def batch_transactions():
+    values = request.get_json()
+
+    if not isinstance(values, dict) or not isinstance(values.get('operations'), list):
+        return "Missing list of operations", 400
+
+    # Room for the whole batch is reserved up front; unknown operations
+    # take none and simply fail
+    with bank.admit(bank.admission(values['operations'])):
+        results, committed = bank.apply_batch(values['operations'], bool(values.get('atomic', False)))
+
     response = {
-            'meta': bank.current_transactions['meta'],
-            'finance': bank.current_transactions['finance'],
-            'hr': bank.current_transactions['hr'],
-            'clients': bank.current_transactions['clients']
+        'committed': committed,
+        'applied': sum(result['ok'] for result in results) if committed else 0,
+        'results': results
     }
-    return jsonify(response), 200
+    return jsonify(response), 200 if committed else 409
 
 @erp.route('/nodes/register', methods=['POST'])
 def register_nodes():
@@ -97,11 +294,22 @@ def register_nodes():
     }
     return jsonify(response), 200
 
+@erp.route('/nodes/resolve', methods=['GET'])
+def consensus():
+    replaced = bank.resolve_conflicts()
+
+    response = {
+        'message': "Chains were replaced" if any(replaced.values()) else "Chains not replaced",
+        'replaced': replaced
+    }
+    return jsonify(response), 200
+
 # ----------------------------------
 #               Meta
 # ----------------------------------
 
 @erp.route('/meta/set', methods=["POST"])
+@admits('meta')
 def meta_transaction():
     values = request.get_json()
     required = ['interest', 'reserve_ratio']
@@ -112,6 +320,7 @@ def meta_transaction():
     index = bank.set_meta(values['interest'], values['reserve_ratio'])
 
     response = {
+        'receipt': receipt('meta', index),
         'message': f'Transactions will be added to Block {index}'
     }
     return jsonify(response), 200
@@ -129,6 +338,7 @@ def reserves_check():
     return jsonify(response), 200
 
 @erp.route('/finance/interbank/borrow', methods=['POST'])
+@admits('finance')
 def borrow():
     values = request.get_json()
     required = ['amount']
@@ -139,11 +349,13 @@ def borrow():
     cash, index = bank.borrow(values['amount'])
 
     response = {
+        'receipt': receipt('finance', index),
         'message': f'Cash at {cash}, transactions will be added to Block {index}'
     }
     return jsonify(response), 200
 
 @erp.route('/finance/interbank/lend', methods=['POST'])
+@admits('finance')
 def lend():
     values = request.get_json()
     required = ['amount']
@@ -154,20 +366,28 @@ def lend():
     cash, index = bank.lend(values['amount'])
 
     response = {
+        'receipt': receipt('finance', index),
         'message': f'Cash at {cash}, transactions will be added to Block {index}'
     }
     return jsonify(response), 200
 
 @erp.route('/finance/interbank/compound', methods=['GET'])
+@admits('finance')
 def interbank_interest():
     nv, index = bank.interbank_compound_interest()
 
     response = {
+        'receipt': receipt('finance', index),
         'message': f'Net value at {nv}, transactions will be added to Block {index}'
     }
     return jsonify(response), 200
 
+@erp.route('/finance/repo', methods=['GET'])
+def repo_position():
+    return jsonify(bank.get_repo().mapped), 200
+
 @erp.route('/finance/repo/buy', methods=['POST'])
+@admits('finance')
 def buy_repo():
     values = request.get_json()
     required = ['yield']
@@ -181,11 +401,13 @@ def buy_repo():
         repo, index = bank.buy_repo(values['yield'])
     par = repo['par']
     response = {
+        'receipt': receipt('finance', index),
         'message': f'Bought at par {par}, transactions will be added to Block {index}'
     }
     return jsonify(response), 200
 
 @erp.route('/finance/repo/sell', methods=['POST'])
+@admits('finance')
 def sell_repo():
     values = request.get_json()
     required = ['yield']
@@ -199,6 +421,7 @@ def sell_repo():
         repo, index = bank.sell_repo(values['yield'])
     par = repo['par']
     response = {
+        'receipt': receipt('finance', index),
         'message': f'Sold at par {par}, transactions will be added to Block {index}'
     }
     return jsonify(response), 200
@@ -208,6 +431,7 @@ def sell_repo():
 # ----------------------------------
 
 @erp.route('/hr/employee/add', methods=["POST"])
+@admits('hr')
 def add_employee():
     values = request.get_json()
     required = ['salary', 'department', 'supervisor_id']
@@ -215,30 +439,72 @@ def add_employee():
     if not all(k in values for k in required):
         return "Missing values", 400
 
-    index = bank.add_employee(values['salary'], values['department'], values['supervisor_id'])
+    employee_num, index = bank.add_employee(values['salary'], values['department'], values['supervisor_id'])
 
     response = {
-        'message': f"Employee will be added to Block {index}"
+        'receipt': receipt('hr', index),
+        'message': f"Employee will be added to Block {index}",
+        'employee_num': employee_num
     }
 
     return jsonify(response), 200
 
+@erp.route('/hr/employee/<employee_num>', methods=['GET'])
+def get_employee(employee_num):
+    try:
+        employee = bank.get_employee(employee_num)
+    except ValueError:
+        return "Employee not found", 404
+
+    return jsonify(employee.mapped), 200
+
+@erp.route('/hr/employee/<employee_num>/reports', methods=['GET'])
+def reporting_tree(employee_num):
+    try:
+        tree = bank.reporting_tree(employee_num)
+    except ValueError:
+        return "Employee not found", 404
+
+    return jsonify(tree), 200
+
+@erp.route('/hr/department/<department>', methods=['GET'])
+def department_roster(department):
+    roster = bank.department_roster(department)
+
+    response = {
+        'department': department,
+        'employees': roster,
+        'length': len(roster)
+    }
+    return jsonify(response), 200
+
 # ----------------------------------
 #              Clients
 # ----------------------------------
 
 @erp.route('/clients/add', methods=['GET'])
+@admits('clients')
 def add_client():
-    index = bank.add_client()
-
-    mine()
+    bank_num, index = bank.add_client()
 
     response = {
+        'receipt': receipt('clients', index),
         'message': f"Client added to the system in block {index}",
+        'bank_num': bank_num
     }
     return jsonify(response), 200
 
+@erp.route('/clients/<bank_num>', methods=['GET'])
+def get_client(bank_num):
+    try:
+        client = bank.view_client(bank_num)
+    except ValueError:
+        return "Client not found", 404
+
+    return jsonify(client.mapped), 200
+
 @erp.route('/clients/open', methods=['POST'])
+@admits('clients', 'open')
 def open_account():
     values = request.get_json()
     required = ['bank_num', 'principal', 'type']
@@ -252,6 +518,7 @@ def open_account():
         return "Associated client with bank number not found", 400
     
     response = {
+        'receipt': receipt('clients', index),
         'message': f"Account created and will be updated in Block {index}",
         'account': account.mapped
     }
@@ -259,6 +526,7 @@ def open_account():
     return jsonify(response), 200
 
 @erp.route('/clients/close', methods=['POST'])
+@admits('clients', 'close')
 def close_account():
     values = request.get_json()
     required = ['bank_num', 'account_num']
@@ -272,6 +540,7 @@ def close_account():
         return "Associated client with bank number and account number not found", 400
     
     response = {
+        'receipt': receipt('clients', index),
         'message': f"Account closed and will be updated in Block {index}",
         'account': account.mapped
     }
@@ -279,6 +548,7 @@ def close_account():
     return jsonify(response), 200
 
 @erp.route('/clients/deposit', methods=['POST'])
+@admits('clients', 'deposit')
 def deposit():
     values = request.get_json()
     required = ['bank_num', 'account_num', 'amount']
@@ -292,6 +562,7 @@ def deposit():
         return "Associated client with bank number not found", 400
     
     response = {
+        'receipt': receipt('clients', index),
         'message': f"Amount deposited and will be updated in Block {index}",
         'account_value': amount
     }
@@ -299,6 +570,7 @@ def deposit():
     return jsonify(response), 200
 
 @erp.route('/clients/withdraw', methods=['POST'])
+@admits('clients', 'withdraw')
 def withdraw():
     values = request.get_json()
     required = ['bank_num', 'account_num', 'amount']
@@ -312,6 +584,7 @@ def withdraw():
         return "Associated client with bank number not found", 400
     
     response = {
+        'receipt': receipt('clients', index),
         'message': f"Amount withdrawn and will be updated in Block {index}",
         'account_value': amount
     }
@@ -319,6 +592,7 @@ def withdraw():
     return jsonify(response), 200
 
 @erp.route('/clients/transfer', methods=['POST'])
+@admits('clients', 'transfer')
 def transfer():
     values = request.get_json()
     required = ['bank_num', 'account_num', 'recipient_num', 'amount']
@@ -332,6 +606,7 @@ def transfer():
         return "Associated client with bank number not found", 400
     
     response = {
+        'receipt': receipt('clients', index),
         'message': f"Amount transferred and will be updated in Block {index}",
         'result': result
     }
@@ -339,10 +614,12 @@ def transfer():
     return jsonify(response), 200
 
 @erp.route('/clients/compound', methods=['GET'])
+@admits('clients')
 def client_compound_interest():
     index = bank.client_compound_interest()
 
     response = {
+        'receipt': receipt('clients', index),
         'message': f'Interest compounded; will be updated in Block {index}'
     }
 
@@ -0,0 +1,45 @@
+import threading
+
+from time import time
+
+
+class Sealer(threading.Thread):
+    """
+    Background thread that seals each chain once enough work is pending.
+
+    A chain is due when it holds max_pending transactions, or when its
+    oldest pending transaction has waited max_age seconds. Requests only
+    append and return a receipt, so their latency never includes a proof
+    of work.
+    """
+
+    def __init__(self, bank, max_pending=100, max_age=5.0, interval=0.05):
+        super().__init__(name='sealer', daemon=True)
+        self.bank = bank
+        self.max_pending = max_pending
+        self.max_age = max_age
+        self.interval = interval
+        self.stopped = threading.Event()
+
+    def due(self, type):
+        count = len(self.bank.current_transactions[type])
+        if count == 0:
+            return False
+        since = self.bank.pending_since[type]
+        return count >= self.max_pending or (since is not None and time() - since >= self.max_age)
+
+    def run(self):
+        while not self.stopped.is_set():
+            due = [type for type in self.bank.chains if self.due(type)]
+            if not due:
+                self.stopped.wait(self.interval)
+                continue
+            try:
+                self.bank.mine(due)
+            except Exception as e:  # Keep sealing the other chains; the next pass retries
+                print(f"Sealing {', '.join(due)} failed: {e}")
+                self.stopped.wait(self.interval)
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
@@ -0,0 +1,45 @@
+import json
+import os
+
+from time import time
+
+
+def write_snapshot(directory, snapshot, keep=3):
+    """
+    Atomically write a state snapshot and prune all but the newest `keep`.
+
+    :param directory: <str> snapshot directory
+    :param snapshot: <dict> heights, tip hashes and materialized state
+    :param keep: <int> number of snapshots to retain
+    :return: <str> path of the new snapshot
+    """
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f'{int(time() * 1000):015d}.json')
+    temp = path + '.tmp'
+
+    with open(temp, 'w') as f:
+        json.dump(snapshot, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp, path)
+
+    for old in list_snapshots(directory)[keep:]:
+        os.remove(old)
+    return path
+
+
+def list_snapshots(directory):
+    # Newest first; names are zero-padded millisecond timestamps
+    if not os.path.isdir(directory):
+        return []
+    names = sorted((name for name in os.listdir(directory) if name.endswith('.json')), reverse=True)
+    return [os.path.join(directory, name) for name in names]
+
+
+def load_snapshots(directory):
+    for path in list_snapshots(directory):
+        try:
+            with open(path) as f:
+                yield json.load(f)
+        except (OSError, ValueError):  # Unreadable or partially written snapshot
+            continue
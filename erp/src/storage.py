@@ -0,0 +1,186 @@
+import json
+import mmap
+import os
+import struct
+import threading
+
+from . import codec
+
+# Index entry per block: segment number, offset in the segment, record length
+ENTRY = struct.Struct('<IQI')
+DIGEST_SIZE = 32
+
+
+class BlockLog:
+    """
+    Append-only, segmented store for the sealed blocks of one chain.
+
+    Each record is the block's 32 byte SHA-256 digest followed by the
+    canonical codec bytes it was hashed from, so nothing is serialized twice.
+    Records go to fixed-size segment files and a separate index of
+    fixed-width entries locates block N, which is then read as a slice of
+    the memory-mapped segment. Appends are fsynced in groups. A lock makes
+    the log safe to read from many threads while one of them appends.
+    """
+
+    def __init__(self, directory, segment_size=64 * 1024 * 1024, sync_every=32):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.segment_size = segment_size
+        self.sync_every = sync_every
+        self.unsynced = 0
+        self.maps = {}
+        self.lock = threading.RLock()
+
+        self.index = open(os.path.join(directory, 'index'), 'a+b', buffering=0)
+        self.length = self.recover()
+
+        if self.length:
+            segment, offset, size = self.entry(self.length - 1)
+            self.segment, self.offset = segment, offset + size
+        else:
+            self.segment, self.offset = 0, 0
+        self.writer = self.cut()
+        self.tail = self.read(self.length - 1) if self.length else None
+
+    def recover(self):
+        # Drop a torn index entry, or entries whose record never fully reached
+        # its segment, left behind by a crash between fsyncs
+        length = os.path.getsize(self.index.name) // ENTRY.size
+        while length:
+            segment, offset, size = self.entry(length - 1)
+            path = self.segment_path(segment)
+            if os.path.exists(path) and os.path.getsize(path) >= offset + size:
+                break
+            length -= 1
+        self.index.truncate(length * ENTRY.size)
+        return length
+
+    def cut(self):
+        # Drop everything past the last indexed record, i.e. bytes a crash
+        # left between writing a record and its index entry, and any later
+        # segments; appends then land exactly where the index says. Returns
+        # the writer for the active segment
+        for segment in list(self.maps):
+            if segment >= self.segment:
+                self.maps.pop(segment).close()
+        later = self.segment + 1
+        while os.path.exists(self.segment_path(later)):
+            os.remove(self.segment_path(later))
+            later += 1
+
+        writer = open(self.segment_path(self.segment), 'ab', buffering=0)
+        writer.truncate(self.offset)
+        os.fsync(writer.fileno())
+        return writer
+
+    def segment_path(self, segment):
+        return os.path.join(self.directory, f'{segment:08d}.seg')
+
+    def entry(self, n):
+        return ENTRY.unpack(os.pread(self.index.fileno(), ENTRY.size, n * ENTRY.size))
+
+    def append(self, block, encoded):
+        with self.lock:
+            digest = bytes.fromhex(block['hash'])
+            record = digest + encoded
+
+            if self.offset and self.offset + len(record) > self.segment_size:
+                self.sync()
+                self.writer.close()
+                self.segment += 1
+                self.offset = 0
+                self.writer = open(self.segment_path(self.segment), 'ab', buffering=0)
+
+            self.writer.write(record)
+            self.index.write(ENTRY.pack(self.segment, self.offset, len(record)))
+            self.offset += len(record)
+            self.length += 1
+            self.tail = block
+
+            self.unsynced += 1
+            if self.unsynced >= self.sync_every:
+                self.sync()
+
+    def truncate(self, length):
+        # Drop every block from position length onward, e.g. when a peer's
+        # fork replaces our tip
+        with self.lock:
+            if length >= self.length:
+                return
+
+            self.sync()
+            self.writer.close()
+            if length:
+                segment, offset, size = self.entry(length - 1)
+                self.segment, self.offset = segment, offset + size
+            else:
+                self.segment, self.offset = 0, 0
+
+            self.writer = self.cut()
+            self.index.truncate(length * ENTRY.size)
+            os.fsync(self.index.fileno())
+
+            self.length = length
+            self.tail = self.read(length - 1) if length else None
+
+    def sync(self):
+        with self.lock:
+            if self.unsynced:
+                os.fsync(self.writer.fileno())
+                os.fsync(self.index.fileno())
+                self.unsynced = 0
+
+    def read(self, n):
+        # Only the slice is taken under the lock; slicing copies, so decoding
+        # can't race with a segment being remapped
+        with self.lock:
+            segment, offset, size = self.entry(n)
+            view = self.map(segment, offset + size)
+            record = view[offset:offset + size]
+
+        if record[DIGEST_SIZE] == codec.VERSION:
+            block = codec.decode(record[DIGEST_SIZE:])
+        else:  # Records written as JSON before the binary codec
+            block = json.loads(record[DIGEST_SIZE:])
+        block['hash'] = record[:DIGEST_SIZE].hex()
+        return block
+
+    def map(self, segment, end):
+        view = self.maps.get(segment)
+        if view is None or len(view) < end:
+            # The active segment keeps growing, so remap it once reads pass the old end
+            if view is not None:
+                view.close()
+            with open(self.segment_path(segment), 'rb') as f:
+                view = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self.maps[segment] = view
+        return view
+
+    def close(self):
+        with self.lock:
+            self.sync()
+            self.writer.close()
+            self.index.close()
+            for view in self.maps.values():
+                view.close()
+            self.maps = {}
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, n):
+        if isinstance(n, slice):
+            return [self.read(i) for i in range(*n.indices(self.length))]
+        with self.lock:
+            if n < 0:
+                n += self.length
+            if not 0 <= n < self.length:
+                raise IndexError("Block index out of range")
+            if n == self.length - 1:
+                return self.tail
+        return self.read(n)
+
+    def __iter__(self):
+        for n in range(self.length):
+            yield self[n]
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The node is run from erp/, where src is importable as a package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,85 @@
+import pytest
+
+from flask import Flask
+
+from src import routes
+from src.bank import Bank
+
+
+def serve(monkeypatch, bank):
+    monkeypatch.setattr(routes, 'bank', bank)
+    app = Flask(__name__)
+    app.register_blueprint(routes.erp)
+    return app.test_client()
+
+
+@pytest.fixture
+def client(monkeypatch):
+    return serve(monkeypatch, Bank(1, difficulty=4))
+
+
+@pytest.mark.parametrize('body', [[1, 2], 'operations', {'operations': {'op': 'borrow'}}])
+def test_batch_rejects_malformed_body(client, body):
+    assert client.post('/transactions/batch', json=body).status_code == 400
+
+
+def test_batch_reports_unhashable_op_as_unknown(client):
+    response = client.post('/transactions/batch', json={'operations': [{'op': ['borrow']}, {'op': {'a': 1}}, 5]})
+    assert response.status_code == 200
+    assert [result['error'] for result in response.get_json()['results']] == ['Unknown operation'] * 3
+
+
+def test_batch_takes_route_field_names(client):
+    operations = [
+        {'op': 'set_meta', 'interest': 0.05, 'reserve_ratio': 0.2},
+        {'op': 'buy_repo', 'yield': 0.1},
+        {'op': 'sell_repo', 'yield': 0.1, 'par': 500}
+    ]
+    response = client.post('/transactions/batch', json={'operations': operations, 'atomic': True})
+    assert response.status_code == 200
+    assert routes.bank.get_meta() == {'interest': 0.05, 'reserve_ratio': 0.2}
+    assert [result['result'] for result in response.get_json()['results'][1:]] == [
+        {'flag': 'buy', 'par': 1000, 'ytm': 0.1},
+        {'flag': 'sell', 'par': 500, 'ytm': 0.1}
+    ]
+
+
+def open_account(client):
+    bank_num = client.get('/clients/add').get_json()['bank_num']
+    response = client.post('/clients/open', json={'bank_num': bank_num, 'principal': 10, 'type': 'checking'})
+    return bank_num, response.get_json()['account']['account_num']
+
+
+def test_batch_reserves_checkpoints_only_when_due(monkeypatch):
+    client = serve(monkeypatch, Bank(1, difficulty=4, max_pending=100, checkpoint_every=50))
+    bank_num, account_num = open_account(client)
+    deposit = {'op': 'deposit', 'bank_num': bank_num, 'account_num': account_num, 'amount': 1}
+
+    # The open event leaves the client one event in, so only the 49th
+    # deposit falls due for a checkpoint
+    assert routes.bank.admission([deposit] * 60) == {'clients': 61}
+    response = client.post('/transactions/batch', json={'operations': [deposit] * 60})
+    assert response.status_code == 200
+    assert len(routes.bank.current_transactions['clients']) == 2 + 60 + 1
+    assert routes.bank.mempools['clients'].reserved == 0
+
+
+def test_batch_that_can_never_fit_is_too_large(monkeypatch):
+    client = serve(monkeypatch, Bank(1, difficulty=4, max_pending=10))
+    response = client.post('/transactions/batch', json={'operations': [{'op': 'borrow', 'amount': 1}] * 11})
+    assert response.status_code == 413
+    assert 'Retry-After' not in response.headers
+
+
+def test_event_at_checkpoint_needs_room_for_both(monkeypatch):
+    client = serve(monkeypatch, Bank(1, difficulty=4, max_pending=4, checkpoint_every=2))
+    bank_num, account_num = open_account(client)
+    deposit = {'bank_num': bank_num, 'account_num': account_num, 'amount': 1}
+
+    # Client checkpoint and open event are pending; the first deposit brings
+    # the client to two events, so it needs a slot for the checkpoint too
+    assert client.post('/clients/deposit', json=deposit).status_code == 200
+    assert len(routes.bank.current_transactions['clients']) == 4
+    response = client.post('/clients/deposit', json=deposit)
+    assert response.status_code == 503
+    assert len(routes.bank.current_transactions['clients']) == 4
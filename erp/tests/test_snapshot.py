@@ -0,0 +1,33 @@
+import os
+import shutil
+
+from src.bank import Bank
+
+
+def test_snapshot_while_other_chains_are_busy(tmp_path):
+    # Sealing only the clients chain must not starve snapshots while
+    # finance always has pending transactions
+    bank = Bank(1, difficulty=4, data_dir=str(tmp_path), snapshot_every=10)
+    for _ in range(20):
+        bank.add_client()
+        bank.borrow(1)
+        bank.mine(['clients'])
+
+    snapshots = os.path.join(str(tmp_path), 'snapshots')
+    assert os.listdir(snapshots)
+    # Taking the pending borrows out for the snapshot put them back after
+    assert len(bank.current_transactions['finance']) == 20
+    assert bank.get_interbank().cash == 20
+    bank.close()
+
+    # The snapshot holds sealed state only, so loading it matches a replay
+    # of the sealed blocks from genesis
+    reloaded = Bank(1, difficulty=4, data_dir=str(tmp_path))
+    assert reloaded.get_interbank().cash == 0
+    state = reloaded.state
+    reloaded.close()
+
+    shutil.rmtree(snapshots)
+    replayed = Bank(1, difficulty=4, data_dir=str(tmp_path))
+    assert replayed.state == state
+    replayed.close()
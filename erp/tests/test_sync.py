@@ -0,0 +1,92 @@
+import copy
+
+from src.bank import Bank
+
+
+def fork(bank, peer, type):
+    # Hand our chain the peer's blocks, as resolve_conflicts would after a fetch
+    return bank.sync_chain(type, -1, copy.deepcopy(list(peer.chains[type])))
+
+
+def test_adopt_drops_pending_for_orphaned_client():
+    bank, peer = Bank(1, difficulty=4), Bank(1, difficulty=4)
+    bank_num, _ = bank.add_client()
+    account, _ = bank.open_account(bank_num, 100, 'checking')
+    bank.mine(['clients'])
+    bank.deposit(bank_num, account.account_num, 5)
+
+    for _ in range(3):
+        peer.add_client()
+        peer.mine(['clients'])
+
+    assert fork(bank, peer, 'clients')
+    assert bank.current_transactions['clients'] == []
+    assert bank_num not in bank.client_states
+    bank.mine()
+    assert bank.audit() == {'meta': None, 'finance': None, 'hr': None, 'clients': None}
+
+
+def test_adopt_rebases_pending_interbank():
+    bank, peer = Bank(1, difficulty=4), Bank(1, difficulty=4)
+    bank.borrow(10)
+
+    peer.borrow(100)
+    peer.mine(['finance'])
+    peer.borrow(1)
+    peer.mine(['finance'])
+
+    assert fork(bank, peer, 'finance')
+    interbank = bank.get_interbank()
+    assert interbank.liabilities == 111
+    assert interbank.cash == 111
+    bank.mine()
+    assert bank.audit() == {'meta': None, 'finance': None, 'hr': None, 'clients': None}
+
+
+def test_extension_folds_only_new_blocks(monkeypatch):
+    bank = Bank(1, difficulty=4)
+    bank_num, _ = bank.add_client()
+    account, _ = bank.open_account(bank_num, 100, 'checking')
+    for _ in range(20):
+        bank.deposit(bank_num, account.account_num, 1)
+        bank.mine(['clients'])
+
+    peer = Bank(1, difficulty=4)
+    peer.chains['clients'] = copy.deepcopy(bank.chains['clients'])
+    peer.rebuild()
+    peer.deposit(bank_num, account.account_num, 10)
+    peer.mine(['clients'])
+
+    bank.deposit(bank_num, account.account_num, 5)
+    bank.borrow(1)
+
+    indexed = []
+    index_transaction = bank.index_transaction
+    monkeypatch.setattr(bank, 'index_transaction', lambda type, data: indexed.append(type) or index_transaction(type, data))
+    tip = len(bank.chains['clients'])
+    assert bank.sync_chain('clients', tip - 1, copy.deepcopy(peer.chains['clients'][tip:]))
+
+    # The new block's one event, then our pending deposit again
+    assert indexed == ['clients', 'clients']
+    assert bank.view_client(bank_num).get_account(account.account_num).amount == 135
+    assert len(bank.current_transactions['finance']) == 1
+
+    aggregates = bank.aggregates.mapped
+    bank.rebuild()
+    assert bank.aggregates.mapped == aggregates
+    bank.mine()
+    assert bank.audit() == {'meta': None, 'finance': None, 'hr': None, 'clients': None}
+
+
+def test_resolve_rejects_ancestor_past_tip(monkeypatch):
+    bank = Bank(1, difficulty=4)
+
+    class Response:
+        status_code = 200
+
+        def json(self):
+            return {'length': 10, 'ancestor': 7}
+
+    bank.nodes.add('peer:5000')
+    monkeypatch.setattr(bank.session, 'post', lambda *args, **kwargs: Response())
+    assert bank.resolve_conflicts() == {'meta': False, 'finance': False, 'hr': False, 'clients': False}
@@ -5,19 +5,103 @@ from time import time
 #Make sure that you do not change the imports and depandacies, I would also recomend exploring https://pypi.org/ for packages that you may not understand
 import hashlib
 import json
+import os
+import threading
 
 from urllib.parse import urlparse
 from uuid import uuid4
 # We Will be building a flask server that emulates a blockchain network, and allows users to create, mine and edit a blockchain network
 import requests
-from flask import Flask, jsonify, request
+from concurrent.futures import ThreadPoolExecutor, TimeoutError, as_completed
+from flask import Flask, Response, jsonify, request, stream_with_context
+from multiprocessing import Pool, Value
+
+# Lowest proof found so far by any proof of work worker
+_found = None
+
+
+def _init_worker(found):
+    global _found
+    _found = found
+
+
+def _search(last_proof, last_hash, difficulty, start, stop):
+    base = hashlib.sha256(f'{last_proof}{last_hash}'.encode())
+    limit = 1 << (256 - difficulty)
+    for proof in range(start, stop):
+        # Stop early once another worker has a lower proof than this whole range
+        if proof % 1024 == 0 and _found is not None and _found.value < start:
+            return None, proof - start
+        guess = base.copy()
+        guess.update(b'%d' % proof)
+        if int.from_bytes(guess.digest(), 'big') < limit:
+            if _found is not None:
+                with _found.get_lock():
+                    if proof < _found.value:
+                        _found.value = proof
+            return proof, proof - start + 1
+    return None, stop - start
+
+
+def _verify_segment(blocks, offset, difficulty):
+    # blocks[0] overlaps the previous segment so the first link can be checked here
+    last_block_hash = Blockchain.compute_hash(blocks[0])
+    if offset == 0 and blocks[0].get('hash', last_block_hash) != last_block_hash:
+        return 0
+
+    for i in range(1, len(blocks)):
+        block = blocks[i]
+        block_hash = Blockchain.compute_hash(block)
+        if block.get('hash', block_hash) != block_hash or block['previous_hash'] != last_block_hash:
+            return offset + i
+        if not Blockchain.valid_proof(blocks[i - 1]['proof'], block['proof'], last_block_hash, difficulty):
+            return offset + i
+        last_block_hash = block_hash
+    return None
+
+
+class PendingFull(Exception):
+    pass
 
 
 class Blockchain:
-    def __init__(self):
+    def __init__(self, workers=None):
         self.current_transactions = []
+        # Bounds on transactions waiting for a block, by count and JSON bytes.
+        # When full, a new transaction is refused at once ('reject') or waits
+        # up to pending_timeout seconds for a block to make room ('block')
+        self.max_pending = 10000
+        self.max_pending_bytes = 4 * 1024 * 1024
+        self.overflow = 'reject'
+        self.pending_timeout = 5.0
+        self.pending_bytes = 0
+        self.pending_peak = 0
+        self.pending_rejected = 0
+        self.pending_waited = 0
+        self.pending_changed = threading.Condition()
         self.chain = []
         self.nodes = set()
+        # Number of leading blocks of self.chain whose links are already verified
+        self.verified = 0
+
+        # Proof of work is split across this many processes
+        self.workers = workers or os.cpu_count() or 1
+        self.chunk_size = 20000
+        self.pool = None
+        self.found = None
+        # One search at a time: every search shares self.found, so concurrent
+        # /mine calls would cut each other's ranges short
+        self.search_lock = threading.Lock()
+        # Leading zero bits required of a proof's hash; 16 matches four hex zeroes
+        self.difficulty = 16
+        self.hash_rate = 0
+
+        # Consensus: seconds to wait for any one peer, and for the whole round
+        self.peer_timeout = 5
+        self.resolve_deadline = 10
+        # One pooled keep-alive session shared by every peer request
+        self.session = requests.Session()
+        self.session.mount('http://', requests.adapters.HTTPAdapter(pool_connections=16, pool_maxsize=16))
 
         # Create the genesis block Sometime in the future using self.new_block({parms}) / Not in Quiz 1
         self.new_block(previous_hash='1', proof=100)
@@ -42,43 +126,130 @@ class Blockchain:
             raise ValueError('Invalid URL')
 
 
-    def valid_chain(self, chain):
-        last_block = chain[0]
-        current_index = 1
+    def valid_chain(self, chain, full=False):
+        """
+        Check the hash links and proofs of chain.
 
-        while current_index < len(chain):
-            block = chain[current_index]
-            print(f'{last_block}')
-            print(f'{block}')
-            print('\n ------------------------------ \n')
-            last_block_hash = self.hash(last_block)
-            if block['previous_hash'] != last_block_hash:
+        Blocks whose hashes match the verified prefix of our own chain are
+        skipped, so only the part that differs gets hashed; full checks
+        every block from genesis in parallel.
+        """
+        if full:
+            if self.verify_chain(chain) is not None:
                 return False
-            
+            if chain is self.chain:
+                self.verified = len(chain)
+            return True
+
+        prefix = self.verified if chain is self.chain else self.shared_prefix(chain)
+
+        # Start from the last shared block so the next one can be linked to it
+        start = max(prefix - 1, 0)
+        trusted = chain is self.chain
+        last_block = None
+        last_block_hash = None
+
+        for index in range(start, len(chain)):
+            block = chain[index]
+            # Peer blocks are hashed from their contents, never trusted as sent
+            block_hash = self.hash(block) if trusted else self.compute_hash(block)
+            if block.get('hash', block_hash) != block_hash:
+                return False
+            if index > start:
+                if block['previous_hash'] != last_block_hash:
+                    return False
+                if not self.valid_proof(last_block['proof'], block['proof'], last_block_hash, self.difficulty):
+                    return False
             last_block = block
-            current_index += 1
-        
+            last_block_hash = block_hash
+
+        if chain is self.chain:
+            self.verified = len(chain)
         return True
 
-    def resolve_conflicts(self):
-        neighbors = self.nodes
-        new_chain = False
+    def verify_chain(self, chain):
+        """
+        Check every link and proof of chain, split into segments across the
+        worker pool.
 
-        max_length = len(self.chain)
+        :return: index of the first invalid block, or None
+        """
+        if self.workers == 1 or len(chain) < 2 * self.workers:
+            return _verify_segment(chain, 0, self.difficulty)
+
+        self.start_pool()
+        size = -(-len(chain) // (self.workers * 4))
+        results = [
+            self.pool.apply_async(_verify_segment, (chain[max(start - 1, 0):start + size], max(start - 1, 0), self.difficulty))
+            for start in range(0, len(chain), size)
+        ]
+        failures = [index for index in (result.get() for result in results) if index is not None]
+        return min(failures) if failures else None
+
+    def start_pool(self):
+        if self.pool is None:
+            self.found = Value('q')
+            self.pool = Pool(self.workers, initializer=_init_worker, initargs=(self.found,))
+
+    def shared_prefix(self, chain):
+        # Number of leading blocks whose hashes match our verified blocks
+        low, high = 0, min(self.verified, len(chain))
+        while low < high:
+            mid = (low + high + 1) // 2
+            if chain[mid - 1].get('hash') == self.chain[mid - 1]['hash']:
+                low = mid
+            else:
+                high = mid - 1
+        return low
+
+    def fetch_chain(self, node):
+        response = self.session.get(f'http://{node}/chain', timeout=self.peer_timeout)
+        if response.status_code != 200:
+            return None
+        return response.json()
 
-        for node in neighbors:
-            response = requests.get(f'http://{node}/chain')
+    def resolve_conflicts(self):
+        """
+        Replace our chain with the longest valid chain among our peers.
 
-            if response.status_code == 200:
-                length = response.json()['length']
-                chain = response.json()['chain']
+        Every peer is asked at once; chains are validated as they arrive, and
+        peers that have not answered by resolve_deadline are left out.
+        """
+        if not self.nodes:
+            return False
 
+        new_chain = False
+        max_length = len(self.chain)
+
+        executor = ThreadPoolExecutor(max_workers=len(self.nodes))
+        futures = [executor.submit(self.fetch_chain, node) for node in self.nodes]
+        try:
+            for future in as_completed(futures, timeout=self.resolve_deadline):
+                try:
+                    values = future.result()
+                except (requests.RequestException, ValueError):  # Unreachable peer or malformed response
+                    continue
+                if values is None:
+                    continue
+
+                length = values['length']
+                chain = values['chain']
                 if length > max_length and self.valid_chain(chain):
                     max_length = length
                     new_chain = chain
+        except TimeoutError:
+            pass
+        finally:
+            # Peers still queued are dropped; ones mid-request finish on their own
+            for future in futures:
+                future.cancel()
+            executor.shutdown(wait=False)
 
         if new_chain:
-            self.chain = new_chain
+            # Only the suffix past our verified prefix was checked, so keep our copy of the prefix
+            prefix = self.shared_prefix(new_chain)
+            self.chain = self.chain[:prefix] + new_chain[prefix:]
+            self.verified = len(self.chain)
             return True
         
         return False
@@ -102,27 +273,34 @@ class Blockchain:
           3) Verify the URl, and give an error message if It is invalid
         """
 
-        block = {
-            'index': len(self.chain) + 1,
-            'timestamp': time(),
-            'transactions': self.current_transactions,
-            'proof': proof,
-            'previous_hash': previous_hash or self.hash(self.chain[-1]),
-        }
+        with self.pending_changed:
+            block = {
+                'index': len(self.chain) + 1,
+                'timestamp': time(),
+                'transactions': self.current_transactions,
+                'proof': proof,
+                'previous_hash': previous_hash or self.hash(self.chain[-1]),
+            }
+            # Reset the current list of transactions in line 72. Remember transactions are stored in self.current_transactions
+            self.current_transactions = []
+            self.pending_bytes = 0
+            self.pending_changed.notify_all()
+
+        # The block is sealed now, so serialize and hash it once and keep the result
+        block['hash'] = self.compute_hash(block)
 
-        # Reset the current list of transactions in line 72. Remember transactions are stored in self.current_transactions
-        self.current_transactions = []
         # In line 74, using self.chain.append() method, add the new object {block} to the blockchain.
         self.chain.append(block)
         return block
 
-    def new_transaction(self, sender, recipient, amount):
+    def new_transaction(self, sender, recipient, amount, bounded=True):
         """
         Creates a new transaction to go into the next mined Block
 
         :param sender: Address of the Sender
         :param recipient: Address of the Recipient
         :param amount: Amount
+        :param bounded: Whether the pending limits apply; the mining reward always goes in
         :return: The index of the Block that will hold this transaction
 
         Implement in Quiz 1:
@@ -130,14 +308,47 @@ class Blockchain:
             1.1) the new transaction to be posted, needs the objects from the params {sender, redipient, amount}
           2) Reset 
         """
-        self.current_transactions.append({
+        transaction = {
             'sender': sender,
             'recipient': recipient,
             'amount': amount,
-        })
+        }
+        size = len(json.dumps(transaction).encode())
+
+        with self.pending_changed:
+            if bounded and self.pending_full(size):
+                if self.overflow == 'block' and size <= self.max_pending_bytes:
+                    self.pending_waited += 1
+                    deadline = time() + self.pending_timeout
+                    while self.pending_full(size) and time() < deadline:
+                        self.pending_changed.wait(deadline - time())
+                if self.pending_full(size):
+                    self.pending_rejected += 1
+                    raise PendingFull("Too many pending transactions, retry after the next block")
+
+            self.current_transactions.append(transaction)
+            self.pending_bytes += size
+            self.pending_peak = max(self.pending_peak, len(self.current_transactions))
         #return the index of the new transaction. Old index can be found self.last_block['index']
         return self.last_block['index'] + 1
 
+    def pending_full(self, size):
+        return len(self.current_transactions) >= self.max_pending or self.pending_bytes + size > self.max_pending_bytes
+
+    @property
+    def pending_stats(self):
+        with self.pending_changed:
+            return {
+                'count': len(self.current_transactions),
+                'bytes': self.pending_bytes,
+                'max_count': self.max_pending,
+                'max_bytes': self.max_pending_bytes,
+                'policy': self.overflow,
+                'peak': self.pending_peak,
+                'rejected': self.pending_rejected,
+                'waited': self.pending_waited
+            }
+
     @property
     def last_block(self):
       """
@@ -146,16 +357,25 @@ class Blockchain:
       return self.chain[-1]
 
     @staticmethod
-    def hash(block):
-        block_str = json.dumps(block, sort_keys=True).encode()
+    def compute_hash(block):
+        contents = {key: value for key, value in block.items() if key != 'hash'}
+        block_str = json.dumps(contents, sort_keys=True).encode()
         return hashlib.sha256(block_str).hexdigest()
 
+    @staticmethod
+    def hash(block):
+        if 'hash' in block:
+            return block['hash']
+        return Blockchain.compute_hash(block)
+
     def proof_of_work(self, last_block):
         """
         Simple Proof of Work Algorithm:
 
-         - Find a number p' such that hash(pp') contains leading 4 zeroes
-         - Where p is the previous proof, and p' is the new proof
+         - Find a number p' such that hash(p h p') starts with self.difficulty zero bits
+         - Where p is the previous proof, h the previous block hash, and p' is the new proof
+         - Consecutive ranges of p' are searched in parallel, and the lowest
+           valid p' is returned so the result matches a single-core search
          
         :param last_block: <dict> last Block
         :return: <int>
@@ -163,22 +383,46 @@ class Blockchain:
 
         last_proof = last_block['proof']
         last_hash = self.hash(last_block)
+        started = time()
 
-        proof = 0
-        while self.valid_proof(last_proof, proof, last_hash) is False:
-            proof += 1
+        if self.workers == 1:
+            proof, hashes = _search(last_proof, last_hash, self.difficulty, 0, 1 << 62)
+        else:
+            proof, hashes = self._parallel_search(last_proof, last_hash)
 
+        elapsed = time() - started
+        self.hash_rate = hashes / elapsed if elapsed else 0
         return proof
 
+    def _parallel_search(self, last_proof, last_hash):
+        with self.search_lock:
+            self.start_pool()
+
+            self.found.value = 1 << 62
+            start = 0
+            hashes = 0
+            span = self.chunk_size * self.workers
+            while True:
+                batch = [
+                    self.pool.apply_async(_search, (last_proof, last_hash, self.difficulty, chunk, chunk + self.chunk_size))
+                    for chunk in range(start, start + span, self.chunk_size)
+                ]
+                results = [result.get() for result in batch]
+                hashes += sum(tried for _, tried in results)
+                proofs = [proof for proof, _ in results if proof is not None]
+                if proofs:
+                    return min(proofs), hashes
+                start += span
+
     @staticmethod
-    def valid_proof(last_proof, proof, last_hash):
+    def valid_proof(last_proof, proof, last_hash, difficulty=16):
         """
         Check if proof meets the target
         """
-        guess = f'{last_proof}{proof}{last_hash}'.encode()
-        guess_hash = hashlib.sha256(guess).hexdigest()
+        guess = f'{last_proof}{last_hash}{proof}'.encode()
+        guess_hash = hashlib.sha256(guess).digest()
 
-        return guess_hash[:4] == "0000"
+        return int.from_bytes(guess_hash, 'big') < 1 << (256 - difficulty)
 
 
 app = Flask(__name__)
@@ -192,7 +436,7 @@ def mine():
     last_block = blockchain.last_block
     proof = blockchain.proof_of_work(last_block)
 
-    blockchain.new_transaction(sender="0", recipient=node_identifier, amount=1)
+    blockchain.new_transaction(sender="0", recipient=node_identifier, amount=1, bounded=False)
     
     previous_hash = blockchain.hash(last_block)
     block = blockchain.new_block(proof, previous_hash)
@@ -202,7 +446,9 @@ def mine():
         'index': block['index'],
         'transactions': block['transactions'],
         'proof': block['proof'],  
-        'previous_hash': block['previous_hash']
+        'previous_hash': block['previous_hash'],
+        'hash': block['hash'],
+        'hash_rate': blockchain.hash_rate
     }
     return jsonify(response), 200
 
@@ -214,18 +460,58 @@ def new_transaction():
     if not all(k in values for k in required):
         return 'Missing values', 400
 
-    index = blockchain.new_transaction(values['sender'], values['recipient'], values['amount'])
+    try:
+        index = blockchain.new_transaction(values['sender'], values['recipient'], values['amount'])
+    except PendingFull as e:
+        return str(e), 503, {'Retry-After': '1'}
 
     response = {
         'message': f'Transactions will be added to Block {index}'
     }
     return jsonify(response), 200
 
+@app.route('/transactions/pending', methods=['GET'])
+def pending_transactions():
+    return jsonify(blockchain.pending_stats), 200
+
 @app.route('/chain', methods=['GET'])
 def full_chain():
+    """
+    Return the chain, optionally a page of it.
+
+    start (or cursor) and limit select a range and the response carries the
+    cursor of the next page. format=ndjson streams one block per line, and a
+    full dump is streamed as chunked JSON so it is never built in memory.
+    """
+    length = len(blockchain.chain)
+    start = max(request.args.get('cursor', request.args.get('start', 0, type=int), type=int), 0)
+    limit = request.args.get('limit', None, type=int)
+    stop = length if limit is None else min(length, start + max(limit, 0))
+    stop = max(stop, start)
+
+    def blocks():
+        for position in range(start, stop):
+            yield blockchain.chain[position]
+
+    if request.args.get('format') == 'ndjson':
+        lines = (json.dumps(block) + '\n' for block in blocks())
+        return Response(stream_with_context(lines), mimetype='application/x-ndjson'), 200
+
+    next_cursor = stop if stop < length else None
+    if limit is None:
+        def document():
+            yield f'{{"length": {length}, "next": {json.dumps(next_cursor)}, "chain": ['
+            comma = ''
+            for block in blocks():
+                yield comma + json.dumps(block)
+                comma = ', '
+            yield ']}'
+        return Response(stream_with_context(document()), mimetype='application/json'), 200
+
     response = {
-            'chain': blockchain.chain,
-            'length': len(blockchain.chain)
+            'chain': list(blocks()),
+            'length': length,
+            'next': next_cursor
     }
     return jsonify(response), 200
 
@@ -268,8 +554,17 @@ if __name__ == '__main__':
 
     parser = ArgumentParser()
     parser.add_argument('-p', '--port', default=5000, type=int, help='port to listen on')
+    parser.add_argument('-w', '--workers', default=None, type=int, help='proof of work processes (defaults to CPU count)')
+    parser.add_argument('--max-pending', default=None, type=int, help='pending transactions accepted before a block')
+    parser.add_argument('--overflow', default='reject', choices=['reject', 'block'], help='what a full pending pool does to new transactions')
     args = parser.parse_args()
     port = args.port
 
+    if args.workers:
+        blockchain.workers = args.workers
+    if args.max_pending:
+        blockchain.max_pending = args.max_pending
+    blockchain.overflow = args.overflow
+
     app.run(host='0.0.0.0', port=port)
  